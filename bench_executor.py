@@ -0,0 +1,112 @@
+"""
+Compare fabric fork-per-host @parallel with threaded executor
+
+    $ python bench_executor.py [HOSTS [WORKERS [LATENCY]]]
+
+Runs task on simulated inventory of HOSTS hosts (200 by default), with at
+most WORKERS (64) hosts at once. Task doesn't connect anywhere, it sleeps
+LATENCY (0.5) seconds instead of remote command and returns
+env.host_string. Wall time, peak process count and peak summary RSS of
+benchmark and all its children are printed for both executors (summary
+RSS counts copy-on-write pages, shared by forked children, many times).
+"""
+
+import os
+import sys
+import time
+import threading
+
+from fabric import api
+from fabric.api import env, task, parallel
+from fabric.context_managers import hide
+
+import executor
+
+
+@task
+@parallel
+def simulated_op(latency):
+    time.sleep(latency)
+    return env.host_string
+
+
+def proc_rss(pid):
+    """rss of process in bytes, 0 if process already finished"""
+    try:
+        with open("/proc/{0}/status".format(pid)) as fd:
+            for line in fd:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+
+def children(pid):
+    res = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(name)) as fd:
+                ppid = int(fd.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            res.append(int(name))
+    return res
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, timeout=0.05):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.timeout = timeout
+        self.stop_evt = threading.Event()
+        self.max_rss = 0
+        self.max_procs = 0
+
+    def run(self):
+        pid = os.getpid()
+        while not self.stop_evt.is_set():
+            pids = [pid] + children(pid)
+            self.max_rss = max(self.max_rss, sum(map(proc_rss, pids)))
+            self.max_procs = max(self.max_procs, len(pids))
+            self.stop_evt.wait(self.timeout)
+
+    def stop(self):
+        self.stop_evt.set()
+        self.join()
+
+
+def bench(name, func, hosts, latency):
+    sampler = RSSSampler()
+    sampler.start()
+    stime = time.time()
+    with hide('everything'):
+        res = func(simulated_op, latency, hosts=hosts)
+    wall = time.time() - stime
+    sampler.stop()
+
+    assert all(res[host] == host for host in hosts), "Wrong results"
+    print "{0:<8} {1:>8.2f}s {2:>6} procs {3:>10.1f} MiB".format(
+        name, wall, sampler.max_procs, sampler.max_rss / 1024.0 ** 2)
+
+
+if __name__ == "__main__":
+    host_count, workers, latency = 200, 64, 0.5
+    if len(sys.argv) > 1:
+        host_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        workers = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        latency = float(sys.argv[3])
+
+    hosts = ["sim-{0:04d}".format(pos) for pos in range(host_count)]
+    env.pool_size = workers
+    executor.max_workers = workers
+
+    print "{0} hosts, {1} workers, {2}s per host".format(host_count,
+                                                         workers, latency)
+    bench("fork", api.execute, hosts, latency)
+    bench("threads", executor.execute_threaded, hosts, latency)
@@ -0,0 +1,212 @@
+import time
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+from fabric import api
+from fabric import state
+from fabric.api import env, settings
+from fabric.network import HostConnectionCache, connect
+from fabric.network import normalize, normalize_to_string, to_dict
+
+
+class ConnectionPool(HostConnectionCache):
+    """fabric connection cache with statistic and limited size
+
+    every host has one ssh connection, all commands run as channels
+    of it. Least recently used connections are closed, when there are
+    more than max_sessions of them.
+
+    Pool is shared by threads of threaded executor: all state is changed
+    under lock, but ssh handshakes are done outside of it, only under
+    lock of connected host, so slow host doesn't block others. Hosts,
+    pinned by running tasks, are never evicted - pool can temporary
+    have more than max_sessions connections.
+    """
+    def init_pool(self, max_sessions):
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.host_locks = {}
+        self.pins = collections.defaultdict(int)
+        self.lru = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.handshakes = 0
+        self.handshake_time = 0.0
+
+    def open(self, key):
+        user, host, port = normalize(key)
+        seek_gateway = True
+        if env.gateway:
+            seek_gateway = normalize_to_string(env.gateway) != key
+
+        stime = time.time()
+        client = connect(user, host, port, cache=self,
+                         seek_gateway=seek_gateway)
+        return client, time.time() - stime
+
+    def connect(self, key):
+        key = normalize_to_string(key)
+        client, handshake_time = self.open(key)
+        with self.lock:
+            return self.add(key, client, handshake_time)
+
+    def add(self, key, client, handshake_time):
+        """store new connection, must be called under lock. If other
+        thread connected to the same host first, its connection is kept"""
+        self.handshakes += 1
+        self.handshake_time += handshake_time
+        if dict.__contains__(self, key):
+            client.close()
+        else:
+            dict.__setitem__(self, key, client)
+        self.lru.pop(key, None)
+        self.lru[key] = True
+        client = dict.__getitem__(self, key)
+        self.evict()
+        return client
+
+    def evict(self):
+        """close least recently used idle connections, must be called
+        under lock"""
+        extra = len(self.lru) - self.max_sessions
+        idle = [key for key in self.lru if self.pins.get(key, 0) == 0]
+        for key in idle[:max(0, extra)]:
+            del self.lru[key]
+            client = dict.pop(self, key, None)
+            if client is not None:
+                client.close()
+
+    def pin(self, host):
+        """don't evict connection to host, until unpin"""
+        with self.lock:
+            self.pins[normalize_to_string(host)] += 1
+
+    def unpin(self, host):
+        key = normalize_to_string(host)
+        with self.lock:
+            self.pins[key] -= 1
+            if self.pins[key] == 0:
+                del self.pins[key]
+            self.evict()
+
+    def lookup(self, key):
+        """cached connection or None, must be called under lock"""
+        if not dict.__contains__(self, key):
+            return None
+        self.hits += 1
+        self.lru.pop(key, None)
+        self.lru[key] = True
+        return dict.__getitem__(self, key)
+
+    def __getitem__(self, key):
+        key = normalize_to_string(key)
+        with self.lock:
+            client = self.lookup(key)
+            if client is not None:
+                return client
+            host_lock = self.host_locks.setdefault(key, threading.Lock())
+
+        with host_lock:
+            with self.lock:
+                client = self.lookup(key)
+                if client is not None:
+                    return client
+                self.misses += 1
+            return self.connect(key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self.lru.pop(normalize_to_string(key), None)
+            return HostConnectionCache.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        with self.lock:
+            self.lru.pop(normalize_to_string(key), None)
+            return dict.pop(self, normalize_to_string(key), *default)
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+            dict.clear(self)
+
+    def prewarm(self, hosts, threads=32):
+        """open connections to all hosts in parallel"""
+        keys = [normalize_to_string(host) for host in hosts]
+        with self.lock:
+            keys = [key for key in set(keys)
+                    if not dict.__contains__(self, key)]
+        keys = keys[:self.max_sessions]
+
+        if len(keys) == 0:
+            return
+
+        pool = ThreadPool(min(threads, len(keys)))
+        try:
+            results = pool.map(self.open, keys)
+        finally:
+            pool.close()
+            pool.join()
+
+        with self.lock:
+            for key, (client, handshake_time) in zip(keys, results):
+                self.add(key, client, handshake_time)
+
+    def stats(self):
+        with self.lock:
+            return {'sessions': len(self),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'handshakes': self.handshakes,
+                    'handshake_time': self.handshake_time}
+
+
+def install_pool(hosts=(), max_sessions=256):
+    """replace fabric connection cache with pool and connect to hosts
+
+    fabric modules keep reference to cache object, so its class is changed
+    in place. Processes, forked by @parallel, still open own connections,
+    so hosts should be given only if this process reuses connections.
+    """
+    if not isinstance(state.connections, ConnectionPool):
+        state.connections.__class__ = ConnectionPool
+        state.connections.init_pool(max_sessions)
+        state.connections.lru.update((key, True) for key in state.connections)
+
+    state.connections.prewarm(hosts)
+    return state.connections
+
+
+def get_pool():
+    if isinstance(state.connections, ConnectionPool):
+        return state.connections
+    return None
+
+
+def execute(task, *args, **kwargs):
+    """fabric execute, which runs single-host tasks in current process,
+    reusing pool connection instead of forking for @parallel tasks"""
+    hosts = kwargs.get('hosts')
+    if get_pool() is None or hosts is None or len(hosts) != 1 \
+            or kwargs.get('roles') or kwargs.get('host'):
+        return api.execute(task, *args, **kwargs)
+
+    kwargs.pop('hosts')
+    host = list(hosts)[0]
+    pool = get_pool()
+    pool.pin(host)
+    try:
+        # user and port of 'user@host:port', as fabric execute sets them
+        with settings(**to_dict(host)):
+            return {host: task(*args, **kwargs)}
+    finally:
+        pool.unpin(host)
+
+
+def print_pool_stats():
+    pool = get_pool()
+    if pool is not None:
+        stats = pool.stats()
+        print ("Connection pool: {sessions} sessions, {hits} hits, " +
+               "{misses} misses, {handshakes} handshakes in " +
+               "{handshake_time:.2f}s").format(**stats)
@@ -0,0 +1,222 @@
+crush_types = ['osd', 'host', 'chassis', 'rack', 'row', 'pdu', 'pod',
+               'room', 'datacenter', 'region', 'root']
+
+
+default_tunables = """tunable choose_local_tries 0
+tunable choose_local_fallback_tries 0
+tunable choose_total_tries 50
+tunable chooseleaf_descend_once 1"""
+
+
+default_rules = """rule replicated_ruleset {{
+    ruleset 0
+    type replicated
+    min_size 1
+    max_size 10
+    step take {root}
+    step chooseleaf firstn 0 type {leaf_type}
+    step emit
+}}"""
+
+
+crush_map_templ = """# begin crush map
+{tunables}
+
+# devices
+{devices}
+
+# types
+{types}
+
+# buckets
+{buckets}
+
+# rules
+{rules}
+
+# end crush map
+"""
+
+
+bucket_templ = """{tp} {name} {{
+{ids}
+    alg straw
+    hash 0
+{items}
+}}"""
+
+
+def make_bucket(tp, name, bucket_id, items, class_ids=None):
+    """class_ids - {device class: id} of shadow buckets, ceph creates
+    missing ones"""
+    ids = ["    id {0}".format(bucket_id)]
+    ids.extend("    id {0} class {1}".format(class_id, dev_class)
+               for dev_class, class_id in sorted((class_ids or {}).items()))
+    items_str = "\n".join("    item {0} weight {1:.3f}".format(*item)
+                          for item in items)
+    return bucket_templ.format(tp=tp, name=name, ids="\n".join(ids),
+                               items=items_str)
+
+
+def parse_crush_map(text):
+    """tunables, devices, buckets and rules of decompiled crush map
+
+    Only maps with host buckets under one root are supported, any other
+    bucket type or bucket line raises ValueError, so merged map never
+    silently drops part of existing one.
+    Device classes (luminous+) are kept: class of device or None, and
+    {class: id} of per-class shadow buckets.
+    Returns (tunables, {osd_num: class},
+             [(type, name, id, {class: id}, [(item, weight)])], rules)
+    """
+    tunables = []
+    devices = {}
+    buckets = []
+    rules = []
+    lines = iter(text.split("\n"))
+
+    for line in lines:
+        line = line.split("#")[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        if parts[0] == 'tunable':
+            tunables.append(line)
+        elif parts[0] == 'device':
+            if len(parts) == 3:
+                dev_class = None
+            elif len(parts) == 5 and parts[3] == 'class':
+                dev_class = parts[4]
+            else:
+                raise ValueError("Unsupported device line: " + line)
+            if parts[2].startswith('osd.'):
+                devices[int(parts[1])] = dev_class
+        elif parts[0] == 'type':
+            pass
+        elif parts[0] == 'rule':
+            rule = [line]
+            for line in lines:
+                rule.append("    " + line.strip())
+                if line.strip() == "}":
+                    break
+            rule[-1] = "}"
+            rules.append("\n".join(rule))
+        elif parts[-1] == '{':
+            tp, name = parts[:2]
+            if tp not in ('host', 'root'):
+                raise ValueError("Unsupported crush bucket {0} {1}".format(
+                    tp, name))
+            bucket_id = None
+            class_ids = {}
+            items = []
+            for line in lines:
+                line = line.split("#")[0].strip()
+                if line == "}":
+                    break
+                parts = line.split()
+                if not parts or parts[0] in ('alg', 'hash'):
+                    continue
+                if parts[0] == 'id' and len(parts) == 2:
+                    bucket_id = int(parts[1])
+                elif parts[0] == 'id' and len(parts) == 4 and \
+                        parts[2] == 'class':
+                    class_ids[parts[3]] = int(parts[1])
+                elif parts[0] == 'item' and len(parts) == 4 and \
+                        parts[2] == 'weight':
+                    items.append((parts[1], float(parts[3])))
+                else:
+                    raise ValueError("Unsupported line in crush bucket "
+                                     "{0}: {1}".format(name, line))
+            buckets.append((tp, name, bucket_id, class_ids, items))
+        else:
+            raise ValueError("Unsupported crush map line: " + line)
+
+    return tunables, devices, buckets, rules
+
+
+def build_crush_map(host_osds, chooseleaf_type=1, root='default',
+                    existing=None):
+    """text crush map with one root and one bucket per host
+
+    host_osds - {hostname: [(osd_num, weight), ...]}
+    chooseleaf_type - failure domain, index in crush_types
+    existing - decompiled current crush map, its hosts, osd's, tunables
+               and rules are kept, osd's from host_osds are added to it,
+               osd's, which are already in it, keep their weight and
+               class, buckets keep ids of their class shadow buckets
+    """
+    host_items = {}
+    bucket_ids = {}
+    class_ids = {}
+    devices = {}
+    tunables = default_tunables
+    rules = default_rules.format(root=root,
+                                 leaf_type=crush_types[int(chooseleaf_type)])
+
+    if existing is not None:
+        old_tunables, old_devices, buckets, old_rules = \
+            parse_crush_map(existing)
+        devices.update(old_devices)
+        for tp, name, bucket_id, bucket_class_ids, items in buckets:
+            if tp == 'root' and name != root:
+                raise ValueError("Crush map has other root " + name)
+            bucket_ids[name] = bucket_id
+            class_ids[name] = bucket_class_ids
+            if tp == 'host':
+                host_items[name] = dict(items)
+            else:
+                hosts = set(item for item, _ in items)
+                unknown = hosts - set(bucket[1] for bucket in buckets
+                                      if bucket[0] == 'host')
+                if unknown:
+                    raise ValueError("Unsupported items in root {0}: "
+                                     "{1}".format(root,
+                                                  ", ".join(sorted(unknown))))
+        if old_tunables:
+            tunables = "\n".join(old_tunables)
+        if old_rules:
+            rules = "\n\n".join(old_rules)
+
+    for host, osds in host_osds.items():
+        items = host_items.setdefault(host, {})
+        for osd_num, weight in osds:
+            items.setdefault("osd.{0}".format(osd_num), float(weight))
+
+    used_ids = [bucket_id for bucket_id in bucket_ids.values()
+                if bucket_id is not None]
+    used_ids.extend(class_id for ids in class_ids.values()
+                    for class_id in ids.values())
+    next_id = min([-1] + used_ids) - 1
+    bucket_ids.setdefault(root, -1)
+    if bucket_ids[root] is None:
+        bucket_ids[root] = next_id
+        next_id -= 1
+
+    buckets = []
+    root_items = []
+
+    for host in sorted(host_items):
+        if bucket_ids.get(host) is None:
+            bucket_ids[host] = next_id
+            next_id -= 1
+        items = sorted(host_items[host].items(),
+                       key=lambda item: int(item[0].split(".")[1]))
+        for name, _ in items:
+            devices.setdefault(int(name.split(".")[1]), None)
+        buckets.append(make_bucket('host', host, bucket_ids[host], items,
+                                   class_ids.get(host)))
+        root_items.append((host, sum(weight for _, weight in items)))
+
+    buckets.append(make_bucket('root', root, bucket_ids[root], root_items,
+                               class_ids.get(root)))
+
+    return crush_map_templ.format(
+        tunables=tunables,
+        devices="\n".join("device {0} osd.{0}".format(osd_num) +
+                          (" class " + devices[osd_num]
+                           if devices[osd_num] else "")
+                          for osd_num in sorted(devices)),
+        types="\n".join("type {0} {1}".format(pos, name)
+                        for pos, name in enumerate(crush_types)),
+        buckets="\n\n".join(buckets),
+        rules=rules)
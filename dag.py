@@ -0,0 +1,245 @@
+import time
+import Queue
+import traceback
+import multiprocessing
+
+from fabric import state
+from fabric.utils import abort, puts
+
+from tracing import execute, phase
+
+
+class Ref(object):
+    """placeholder for result of other step, resolved before step start"""
+    def __init__(self, name):
+        self.name = name
+
+
+class Step(object):
+    def __init__(self, name, func, args, kwargs, host, deps,
+                 verify, journaled, after_failed):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.host = host
+        self.verify = verify
+        self.journaled = journaled
+        self.after_failed = after_failed
+        self.ref_deps = set(arg.name for arg in list(args) + kwargs.values()
+                            if isinstance(arg, Ref))
+        self.deps = set(deps) | self.ref_deps
+
+    def blocked(self, failed):
+        """some of deps failed and step can't run"""
+        if self.after_failed:
+            return bool(self.ref_deps & failed)
+        return bool(self.deps & failed)
+
+    def ready(self, results, failed):
+        if self.after_failed:
+            return self.deps.issubset(set(results) | failed)
+        return self.deps.issubset(results)
+
+    def resolve(self, results):
+        def resolve_val(val):
+            if isinstance(val, Ref):
+                return results[val.name]
+            return val
+
+        args = [resolve_val(arg) for arg in self.args]
+        kwargs = dict((key, resolve_val(val))
+                      for key, val in self.kwargs.items())
+        return args, kwargs
+
+
+def call_on_host(func, host, *args, **kwargs):
+    if host is None:
+        return func(*args, **kwargs)
+    return execute(func, *args, hosts=[host], **kwargs)[host]
+
+
+def run_step(step, args, kwargs, record, res_q):
+    # don't share ssh connections with parent process
+    state.connections.clear()
+    try:
+        with phase(step.name):
+            if record is not None and call_on_host(step.verify, step.host):
+                puts("Step {0} verified, skipping".format(step.name))
+                res_q.put((step.name, True, record['result'], True))
+            else:
+                res = call_on_host(step.func, step.host, *args, **kwargs)
+                res_q.put((step.name, True, res, False))
+    except BaseException as exc:
+        traceback.print_exc()
+        res_q.put((step.name, False, str(exc), False))
+
+
+class DAG(object):
+    """deployment steps with dependencies
+
+    steps are fabric tasks, executed on one host each (or locally
+    if host is None) in separated processes. At most max_parallel
+    steps run at the same time and at most max_per_host on any host.
+
+    If journal is given, results of finished steps are recorded in it.
+    On next run recorded steps are not executed again, if they have no
+    verify function or verify(), executed on step host, returns True.
+    Results of journaled steps must be json-serializable. When journaled
+    step is executed again, records of all steps, depending on it, and
+    their sub-records ('step_name/...' keys) are dropped.
+
+    Step with after_failed=True runs after all its deps are finished, even
+    if some of them failed, unless it takes their results via Ref.
+    """
+    def __init__(self, max_parallel=16, max_per_host=1, journal=None):
+        self.max_parallel = max_parallel
+        self.max_per_host = max_per_host
+        self.journal = journal
+        self.steps = []
+
+    def add(self, name, func, *args, **kwargs):
+        host = kwargs.pop('host', None)
+        deps = kwargs.pop('deps', ())
+        verify = kwargs.pop('verify', None)
+        journaled = kwargs.pop('journaled', True)
+        after_failed = kwargs.pop('after_failed', False)
+
+        assert all(step.name != name for step in self.steps)
+        self.steps.append(Step(name, func, args, kwargs, host, deps,
+                               verify, journaled, after_failed))
+        return name
+
+    def get_record(self, step):
+        if self.journal is None or not step.journaled:
+            return None
+        return self.journal.get(step.name)
+
+    def dependents(self, name):
+        res = set()
+        new = set([name])
+        while new:
+            res.update(new)
+            new = set(step.name for step in self.steps
+                      if step.deps & new) - res
+        res.remove(name)
+        return res
+
+    def find_cycle(self):
+        """list of step names, forming dependency cycle, or None"""
+        deps = dict((step.name, sorted(step.deps)) for step in self.steps)
+        done = set()
+
+        for start in sorted(deps):
+            # depth-first walk, path holds names of stack items
+            path = [start]
+            stack = [iter(deps[start])]
+            while stack:
+                for dep in stack[-1]:
+                    if dep in path:
+                        return path[path.index(dep):] + [dep]
+                    if dep not in done:
+                        path.append(dep)
+                        stack.append(iter(deps[dep]))
+                        break
+                else:
+                    stack.pop()
+                    done.add(path.pop())
+        return None
+
+    def invalidate_dependents(self, name):
+        records = self.journal.load()
+        for dep_name in self.dependents(name):
+            for key in records:
+                if key == dep_name or key.startswith(dep_name + "/"):
+                    self.journal.forget(key)
+
+    def can_start(self, step, running):
+        if len(running) >= self.max_parallel:
+            return False
+
+        if step.host is None:
+            return True
+
+        on_host = sum(1 for other, _, _ in running.values()
+                      if other.host == step.host)
+        return on_host < self.max_per_host
+
+    def run(self, warn_only=False):
+        """returns {step_name: result} for all finished steps"""
+        names = set(step.name for step in self.steps)
+        for step in self.steps:
+            unknown = step.deps - names
+            assert not unknown, "Unknown deps {0} of {1}".format(unknown,
+                                                                 step.name)
+        cycle = self.find_cycle()
+        assert cycle is None, "Deps cycle " + " -> ".join(cycle)
+
+        results = {}
+        failed = set()
+        running = {}
+        pending = list(self.steps)
+        res_q = multiprocessing.Queue()
+
+        while pending or running:
+            progress = False
+            for step in pending[:]:
+                if step.blocked(failed):
+                    puts("Step {0} skipped".format(step.name))
+                    failed.add(step.name)
+                    pending.remove(step)
+                    progress = True
+                elif step.ready(results, failed) and \
+                        self.can_start(step, running):
+                    record = self.get_record(step)
+                    if record is not None and step.verify is None:
+                        puts("Step {0} already done".format(step.name))
+                        results[step.name] = record['result']
+                        pending.remove(step)
+                        progress = True
+                        continue
+
+                    args, kwargs = step.resolve(results)
+                    proc = multiprocessing.Process(target=run_step,
+                                                   args=(step, args, kwargs,
+                                                         record, res_q))
+                    proc.start()
+                    running[step.name] = (step, proc, time.time())
+                    pending.remove(step)
+
+            if not running:
+                if pending and not progress:
+                    abort("Steps can't start: " +
+                          ", ".join(sorted(step.name for step in pending)))
+                continue
+
+            try:
+                name, ok, res, reused = res_q.get(timeout=1)
+            except Queue.Empty:
+                for name, (step, proc, _) in running.items():
+                    if not proc.is_alive() and res_q.empty():
+                        puts("Step {0} died with code {1}".format(
+                            name, proc.exitcode))
+                        failed.add(name)
+                        del running[name]
+                continue
+
+            step, proc, stime = running.pop(name)
+            proc.join()
+
+            if ok:
+                results[name] = res
+                if self.journal is not None and step.journaled \
+                        and not reused:
+                    self.invalidate_dependents(name)
+                    self.journal.record(name, result=res)
+                puts("Step {0} done in {1:.1f}s".format(name,
+                                                        time.time() - stime))
+            else:
+                failed.add(name)
+                puts("Step {0} failed: {1}".format(name, res))
+
+        if failed and not warn_only:
+            abort("Failed steps: " + ", ".join(sorted(failed)))
+
+        return results
@@ -1,58 +1,72 @@
 import sys
 import json
 import uuid
-import socket
+import base64
 import os.path
 from StringIO import StringIO
 
-import yaml
-
+from dag import DAG, Ref
+from crush import build_crush_map
+from journal import Journal
+from facts import get_facts
+from tracing import run, sudo, put, get, exists, append, execute
+from remote import push_files, run_jobs, run_script
+from inventory import Inventory, compile_inventory, config_hosts
+from conn_pool import install_pool, print_pool_stats
+from pkg_cache import mirror_url, start_from_cfg, print_cache_stats
+from osd_ramp import ramp_config, ramp_osds
+from disk_preflight import run_preflight
+
+from fabric.utils import abort, puts
 from fabric.context_managers import hide
 from fabric.network import disconnect_all
-from fabric.contrib.files import append, exists
-from fabric.api import parallel, put, local, env
-from fabric.api import run, sudo, execute, task, get
+from fabric.api import parallel, local, env, task
 
 
 rpm_repo = """[ceph-noarch]
 name=Ceph noarch packages
-baseurl=http://ceph.com/rpm-{ceph_release}/{release}/noarch
+baseurl={ceph_url}/rpm-{ceph_release}/{release}/noarch
 enabled=1
 gpgcheck=1
 type=rpm-md
-gpgkey=https://ceph.com/git/?p=ceph.git;a=blob_plain;f=keys/release.asc
+gpgkey={gpgkey}
 priority=1
 
 [ceph]
 name=Ceph packages
-baseurl=http://ceph.com/rpm-{ceph_release}/{release}/x86_64
+baseurl={ceph_url}/rpm-{ceph_release}/{release}/x86_64
 enabled=1
 gpgcheck=1
 type=rpm-md
-gpgkey=https://ceph.com/git/?p=ceph.git;a=blob_plain;f=keys/release.asc
+gpgkey={gpgkey}
 priority=1
 
 [ceph-source]
 name=Ceph source packages
-baseurl=http://ceph.com/rpm-{ceph_release}/{release}/SRPMS/
+baseurl={ceph_url}/rpm-{ceph_release}/{release}/SRPMS/
 enabled=1
 gpgcheck=1
 type=rpm-md
-gpgkey=https://ceph.com/git/?p=ceph.git;a=blob_plain;f=keys/release.asc
+gpgkey={gpgkey}
 priority=1
 """
 
+ceph_url = "http://ceph.com"
+ceph_gpgkey = "https://ceph.com/git/?p=ceph.git;a=blob_plain;f=keys/release.asc"
+
 
 def get_distro():
-    if exists("/etc/redhat-release"):
-        return 'rh'
-    return 'ubuntu'
+    return get_facts()['distro']
 
 
 @task
-def prepare_node(ceph_release, hosts_file):
+def prepare_node(ceph_release, hosts_file, cache_url=None):
+    gpgkey = mirror_url(cache_url, ceph_gpgkey)
+
     if 'rh' == get_distro():
-        repo_fc = rpm_repo.format(release='el7', ceph_release=ceph_release)
+        repo_fc = rpm_repo.format(release='el7', ceph_release=ceph_release,
+                                  ceph_url=mirror_url(cache_url, ceph_url),
+                                  gpgkey=gpgkey)
         sudo("systemctl stop firewalld.service", warn_only=True)
         if not exists('/etc/ceph'):
             sudo("mkdir /etc/ceph")
@@ -68,17 +82,15 @@ def prepare_node(ceph_release, hosts_file):
 
         ntp_service = 'ntpd'
     else:
-        add_ceph_dev_repo_keys = "wget -q -O- " + \
-                                 "'https://ceph.com/git/?p=ceph.git" + \
-                                 ";a=blob_plain;f=keys/release.asc' " + \
-                                 "| apt-key add -"
-        sudo(add_ceph_dev_repo_keys)
-
-        add_ceph_dev_repo_templ = "echo deb http://ceph.com/" + \
-                                  "debian-{0}/ " + \
+        add_ceph_dev_repo_keys = "wget -q -O- '{0}' | apt-key add -"
+        sudo(add_ceph_dev_repo_keys.format(gpgkey))
+
+        add_ceph_dev_repo_templ = "echo deb {0}/" + \
+                                  "debian-{1}/ " + \
                                   "$(lsb_release -sc) main | tee /etc/apt/" + \
                                   "sources.list.d/ceph.list"
-        sudo(add_ceph_dev_repo_templ.format(ceph_release))
+        sudo(add_ceph_dev_repo_templ.format(mirror_url(cache_url, ceph_url),
+                                            ceph_release))
 
         with hide('stdout', 'stderr'):
             sudo("apt-get update")
@@ -99,21 +111,11 @@ def prepare_node(ceph_release, hosts_file):
     sudo("service " + ntp_service + " start")
 
 
-def get_config(conf_path):
-
-    cfg = yaml.load(open(conf_path).read())
-
-    class Params(object):
-        locals().update(cfg)
-
-    Params.hostname = run("hostname")
-    Params.monmap_path = Params.monmap_path.format(Params)
-    Params.ceph_cfg_path = Params.ceph_cfg_path.format(Params)
-    Params.mon_keyring_path = Params.mon_keyring_path.format(Params)
-    Params.admin_keyring_path = Params.admin_keyring_path.format(Params)
-    Params.first_mon_ip = socket.gethostbyname(Params.mons[0])
-
-    return Params
+def get_config(conf):
+    """conf - path to deployment config or compiled Inventory"""
+    if not isinstance(conf, Inventory):
+        conf = compile_inventory(conf)
+    return conf.params_class(get_facts()['hostname'])
 
 
 ceph_config_templ = """
@@ -144,11 +146,13 @@ osd crush chooseleaf type = {0.crush_chooseleaf_type}
 
 
 @task
-def deploy_first_mon(config_path, mon_ip, hosts_file):
+def deploy_first_mon(config_path, mon_ip, hosts_file, prepare=True):
     params = get_config(config_path)
     params.fsid_uuid = str(uuid.uuid4())
 
-    prepare_node(params.ceph_release, hosts_file)
+    if prepare:
+        prepare_node(params.ceph_release, hosts_file,
+                     getattr(params, 'pkg_cache_url', None))
     mons = ",".join(params.mons)
     ceph_config_file = ceph_config_templ.format(params,
                                                 mons,
@@ -157,6 +161,10 @@ def deploy_first_mon(config_path, mon_ip, hosts_file):
     if params.fs_type == 'ext4':
         ceph_config_file += '\nfilestore xattr use omap = true\n'
 
+    if getattr(params, 'crush_batch', False):
+        # crush map is set once by apply_crush_map
+        ceph_config_file += '\nosd crush update on start = false\n'
+
     sudo("rm -f {0.ceph_cfg_path}".format(params))
 
     put(remote_path=params.ceph_cfg_path,
@@ -206,8 +214,18 @@ def deploy_first_mon(config_path, mon_ip, hosts_file):
 
     commands_templ += """\n\nceph osd lspools\n\nceph -s"""
 
-    for cmd in prepare_cmds(commands_templ.format(params, mon_ip)):
-        run(cmd)
+    run_script(prepare_cmds(commands_templ.format(params, mon_ip)))
+    return params.fsid_uuid
+
+
+@task
+def node_prepared():
+    return run("which ceph-osd", warn_only=True, quiet=True).succeeded
+
+
+@task
+def mon_running():
+    return run("ceph mon stat", warn_only=True, quiet=True).succeeded
 
 
 @task
@@ -216,6 +234,105 @@ def allocate_osd_id(params):
     return run("ceph osd create {0.osd_uuid}".format(params))
 
 
+@task
+def reserve_osd_ids(osd_uuids):
+    res = run_script(["ceph osd create " + osd_uuid for osd_uuid in osd_uuids])
+    return [int(cmd_res.stdout.strip()) for cmd_res in res]
+
+
+def registered_osds(osd_ids, journal):
+    """osd_ids, filtered to osd's, registered according to journal"""
+    if journal is None:
+        return osd_ids
+    res = {}
+    for host, osds in osd_ids.items():
+        osds = [(dev, osd_num, osd_uuid) for dev, osd_num, osd_uuid in osds
+                if (journal.get(osd_journal_key(host, dev)) or
+                    {}).get('osd_num') == osd_num]
+        if osds:
+            res[host] = osds
+    return res
+
+
+@task
+def apply_crush_map(osd_ids, osd_weight, chooseleaf_type, weights=None,
+                    journal=None):
+    """add all osd's to current crush map at once
+
+    osd_ids - {hostname: [(storage_dev, osd_num, osd_uuid), ...]}
+    weights - {hostname: {storage_dev: weight}} from preflight, osd's
+              without it get osd_weight
+    journal - if given, only osd's, registered according to it, are added
+    """
+    weights = weights or {}
+    host_osds = {}
+    for host, osds in registered_osds(osd_ids, journal).items():
+        host_weights = weights.get(host, {})
+        host_osds[host] = [(osd_num, float(host_weights.get(dev, osd_weight)))
+                           for dev, osd_num, _ in osds]
+
+    if not host_osds:
+        puts("No registered osd's to add to crush map")
+        return
+
+    with hide('stdout'):
+        existing = run("ceph osd getcrushmap -o /tmp/crushmap.cur " +
+                       "2>/dev/null && crushtool -d /tmp/crushmap.cur")
+    run("rm -f /tmp/crushmap.cur")
+
+    # refuses maps, which can't be merged without dropping anything
+    crush_map = build_crush_map(host_osds, chooseleaf_type,
+                                existing=existing)
+
+    cmds = """
+    echo {0} | base64 -d > /tmp/crushmap.txt
+
+    crushtool -c /tmp/crushmap.txt -o /tmp/crushmap.bin
+
+    ceph osd setcrushmap -i /tmp/crushmap.bin
+
+    rm -f /tmp/crushmap.txt /tmp/crushmap.bin
+    """.format(base64.b64encode(crush_map))
+
+    run_script(prepare_cmds(cmds))
+
+
+def get_osd_devs(osd_cfg):
+    storage_devs = osd_cfg['storage'].split(" ")
+
+    if 'journal' in osd_cfg:
+        j_devs = osd_cfg['journal'].split(" ")
+
+        assert len(storage_devs) == len(j_devs)
+        assert len(set(storage_devs)) == len(storage_devs)
+        assert len(set(j_devs)) == len(j_devs)
+    else:
+        j_devs = [None] * len(storage_devs)
+
+    return zip(storage_devs, j_devs)
+
+
+def reserve_osds(osd_cfg, mon_ip, hosts):
+    """allocate osd id's for all storage devices of hosts at once
+
+    osd_cfg - 'osd' section of deployment config
+    returns {hostname: [(storage_dev, osd_num, osd_uuid), ...]}
+    """
+    plan = []
+    for host in hosts:
+        for stor, _ in get_osd_devs(osd_cfg[host]):
+            plan.append((host, stor, str(uuid.uuid4())))
+
+    osd_uuids = [osd_uuid for _, _, osd_uuid in plan]
+    osd_nums = execute(reserve_osd_ids, osd_uuids, hosts=[mon_ip])[mon_ip]
+    assert len(osd_nums) == len(plan)
+
+    osd_ids = dict((host, []) for host in hosts)
+    for (host, stor, osd_uuid), osd_num in zip(plan, osd_nums):
+        osd_ids[host].append((stor, osd_num, osd_uuid))
+    return osd_ids
+
+
 @task
 @parallel
 def read_config(params):
@@ -228,6 +345,12 @@ def read_config(params):
     return cfg, fd.getvalue()
 
 
+@task
+def fetch_ceph_config(params):
+    cfg, adm = read_config(params)
+    return {params.ceph_cfg_path: cfg, params.admin_keyring_path: adm}
+
+
 def prepare_cmds(commands):
     result = [""]
     for cmd in commands.split("\n\n"):
@@ -267,8 +390,7 @@ def start_osd_after_reboot(conf_path):
     sudo start ceph-osd id={0.osd_num}
     """
 
-    for cmd in prepare_cmds(commands_templ.format(params)):
-        run(cmd)
+    run_script(prepare_cmds(commands_templ.format(params)))
 
 
 @task
@@ -346,28 +468,33 @@ def up_node(conf_path):
 
 @task
 @parallel
-def add_new_osd(conf_path, hosts_file):
+def add_new_osd(conf_path, hosts_file, osd_ids=None, prepare=True,
+                journal=None, weights=None, crush_batch=False,
+                external_ramp=False):
+    """with crush_batch osd's are not added to crush map, apply_crush_map
+    must be called after it for all hosts.
+
+    With osd_ramp in config osd's are added with crush weight 0 and raised
+    by ramp_osds after registration; with external_ramp caller does it
+    (install_dag ramps osd's of all hosts at once, while ramps of several
+    hosts, run by this task in parallel, don't share backfill budget)"""
     params = get_config(conf_path)
     assert params.fs_type == 'xfs'
     mon_ip = params.first_mon_ip
 
     if not exists(params.ceph_cfg_path):
-        prepare_node(params.ceph_release, hosts_file)
-        cfg, adm = execute(read_config, params, hosts=[mon_ip])[mon_ip]
-
-        put(remote_path=params.ceph_cfg_path,
-            local_path=StringIO(cfg),
-            use_sudo=True)
-
-        # put admin keyring
-        put(remote_path=params.admin_keyring_path,
-            local_path=StringIO(adm),
-            use_sudo=True)
-
-    run("ceph osd crush add-bucket {0} host".format(params.hostname))
-    run("ceph osd crush move {0} root=default".format(params.hostname))
-
-    commands_templ = """
+        if prepare:
+            prepare_node(params.ceph_release, hosts_file,
+                         getattr(params, 'pkg_cache_url', None))
+        files = execute(fetch_ceph_config, params, hosts=[mon_ip])[mon_ip]
+        push_files(files)
+
+    if not crush_batch:
+        run("ceph osd crush add-bucket {0} host".format(params.hostname))
+        run("ceph osd crush move {0} root=default".format(params.hostname))
+
+    # local per-disk steps, executed concurrently for all disks
+    prepare_templ = """
     sudo mkdir -p {0.data_mount_path}
 
     sudo mkfs.xfs -f {0.osd_data_dev}
@@ -376,47 +503,171 @@ def add_new_osd(conf_path, hosts_file):
 
     sudo ceph-osd -c {0.ceph_cfg_path} -i {0.osd_num}
         --cluster {0.clustername} --mkfs --mkkey --osd-uuid {0.osd_uuid}
+    """
 
-    sudo ceph auth add osd.{0.osd_num} osd 'allow *' mon 'allow profile osd' -i
+    # cluster-mutating steps, executed disk by disk in osd id order, can
+    # be rerun - registered key is deleted only if it isn't the key of
+    # osd keyring (osd was re-prepared), so running osd is kept
+    register_templ = """
+    key=$(sudo ceph auth get-key osd.{0.osd_num} 2>/dev/null) ;
+        [ -z "$key" ] ||
+        sudo grep -qF "$key" /var/lib/ceph/osd/{0.clustername}-{0.osd_num}/keyring ||
+        sudo ceph auth del osd.{0.osd_num} ;
+        sudo ceph auth add osd.{0.osd_num} osd 'allow *' mon 'allow profile osd' -i
         /var/lib/ceph/osd/{0.clustername}-{0.osd_num}/keyring
     """
 
     if 'rh' == get_distro():
-        commands_templ += "\n\nsudo touch /var/lib/ceph/osd/{0.clustername}-{0.osd_num}/sysvinit"
-        commands_templ += "\n\nsudo /etc/init.d/ceph start osd.{0.osd_num}"
+        register_templ += "\n\nsudo touch /var/lib/ceph/osd/{0.clustername}-{0.osd_num}/sysvinit"
+        register_templ += "\n\nsudo /etc/init.d/ceph start osd.{0.osd_num}"
     else:
-        commands_templ += "\n\nsudo start ceph-osd id={0.osd_num}"
+        register_templ += "\n\nsudo start ceph-osd id={0.osd_num} || " + \
+            "sudo status ceph-osd id={0.osd_num} | grep -q start/running"
 
-    commands_templ += """\n
-    ceph osd crush add {0.osd_num} {0.osd_weigth} host={0.hostname}
+    ramp = None
+    if not crush_batch and not external_ramp:
+        ramp = ramp_config(getattr(params, 'osd_ramp', None))
 
-    ceph -s
-    """
+    if not crush_batch:
+        register_templ += """\n
+        ceph osd crush add {0.osd_num} {0.crush_weight} host={0.hostname}
+        """
 
-    mp_templ = params.data_mount_path
+    if osd_ids is None:
+        osd_ids = reserve_osds(params.osd, mon_ip, [params.hostname])
+
+    host_weights = (weights or {}).get(params.hostname, {})
+    osds = [osd_params(params, osd_num, osd_uuid, stor,
+                       host_weights.get(stor),
+                       ramp=external_ramp or ramp is not None)
+            for stor, osd_num, osd_uuid in osd_ids[params.hostname]]
+
+    # registered osd's are skipped, prepared ones are only registered
+    ready = set()
+    if journal is not None:
+        osds = skip_journaled_osds(journal, osds)
+        ready = verified_osds(journal, osds, osd_prepare_key, "prepared")
+
+    to_prepare = [osd for osd in osds if osd.osd_num not in ready]
+    workers = getattr(params, 'osd_prepare_workers', 4)
+    prepare_jobs = [prepare_cmds(prepare_templ.format(osd))
+                    for osd in to_prepare]
+    prepare_res = run_jobs(prepare_jobs, max_workers=workers, warn_only=True)
+
+    prepared = [osd for osd in osds if osd.osd_num in ready]
+    failed = []
+    for osd, job, res in zip(to_prepare, prepare_jobs, prepare_res):
+        if not report_osd_job(osd, "prepare", job, res):
+            failed.append(osd)
+            continue
+        prepared.append(osd)
+        if journal is not None:
+            journal.record(osd_prepare_key(osd.hostname, osd.osd_data_dev),
+                           osd_num=osd.osd_num,
+                           osd_uuid=osd.osd_uuid)
+
+    prepared.sort(key=lambda osd: osd.osd_num)
+    register_jobs = [prepare_cmds(register_templ.format(osd))
+                     for osd in prepared]
+    register_res = run_jobs(register_jobs, warn_only=True)
+
+    registered = []
+    for osd, job, res in zip(prepared, register_jobs, register_res):
+        if not report_osd_job(osd, "register", job, res):
+            failed.append(osd)
+            continue
+        registered.append(osd)
+        if journal is not None:
+            journal.record(osd_journal_key(osd.hostname, osd.osd_data_dev),
+                           osd_num=osd.osd_num,
+                           osd_uuid=osd.osd_uuid)
+
+    if ramp is not None and registered:
+        ramp_osds({params.hostname: [(osd.osd_data_dev, osd.osd_num,
+                                      osd.osd_uuid) for osd in registered]},
+                  params.osd_weigth, ramp, weights)
+
+    run("ceph -s")
+
+    if len(failed) != 0:
+        abort("Failed to add osd's: " +
+              ", ".join("osd.{0.osd_num}({0.osd_data_dev})".format(osd)
+                        for osd in failed))
+
+
+def osd_params(params, osd_num, osd_uuid, dev, weight=None, ramp=False):
+    class OSDParams(params):
+        pass
+
+    OSDParams.osd_num = osd_num
+    OSDParams.osd_uuid = osd_uuid
+    OSDParams.osd_data_dev = dev
+    # with weight ramp osd is added empty and raised by ramp_osds
+    if ramp:
+        OSDParams.crush_weight = 0
+    elif weight is not None:
+        OSDParams.crush_weight = weight
+    else:
+        OSDParams.crush_weight = params.osd_weigth
+    OSDParams.data_mount_path = params.data_mount_path.format(OSDParams)
+    return OSDParams
 
-    storage_devs = params.osd[params.hostname]['storage'].split(" ")
 
-    if 'journal' in params.osd[params.hostname]:
-        j_devs = params.osd[params.hostname]['journal'].split(" ")
+def osd_journal_key(hostname, dev):
+    """journal key of registered osd"""
+    return "osd:{0}/{1}".format(hostname, dev)
+
+
+def osd_prepare_key(hostname, dev):
+    """journal key of osd with created fs and key, but maybe not
+    registered"""
+    return osd_journal_key(hostname, dev) + "/prepare"
 
-        assert len(storage_devs) == len(j_devs)
-        assert len(set(storage_devs)) == len(storage_devs)
-        assert len(set(j_devs)) == len(j_devs)
-    else:
-        j_devs = [None] * len(storage_devs)
 
-    for stor, _ in zip(storage_devs, j_devs):
-        params.osd_uuid = str(uuid.uuid4())
+def verified_osds(journal, osds, key_func, state):
+    """osd_num's of osd's, recorded in journal under key_func key, which
+    data dir contains expected id"""
+    recorded = []
+    for osd in osds:
+        record = journal.get(key_func(osd.hostname, osd.osd_data_dev))
+        if record is not None and record['osd_num'] == osd.osd_num:
+            recorded.append(osd)
 
-        params.osd_num = execute(allocate_osd_id, params,
-                                 hosts=[mon_ip])[mon_ip]
+    if len(recorded) == 0:
+        return set()
 
-        params.osd_data_dev = stor
-        params.data_mount_path = mp_templ.format(params)
+    checks = [["sudo grep -qx {0.osd_num} {0.data_mount_path}/whoami".format(osd)]
+              for osd in recorded]
 
-        for cmd in prepare_cmds(commands_templ.format(params)):
-            run(cmd)
+    verified = set()
+    for osd, res in zip(recorded, run_jobs(checks, warn_only=True)):
+        if len(res) != 0 and not res[-1].failed:
+            puts("osd.{0.osd_num} {0.osd_data_dev}: already {1}".format(
+                osd, state))
+            verified.add(osd.osd_num)
+    return verified
+
+
+def skip_journaled_osds(journal, osds):
+    """filter out registered osd's, recorded in journal, which data dir
+    contains expected id"""
+    deployed = verified_osds(journal, osds, osd_journal_key, "deployed")
+    return [osd for osd in osds if osd.osd_num not in deployed]
+
+
+def report_osd_job(osd, stage, job, results):
+    """job succeeded only if all its commands ran and none failed"""
+    expected = sum(1 for cmd in job if cmd.strip() != "")
+    stime = min(res.stime for res in results) if results else 0
+    etime = max(res.etime for res in results) if results else 0
+
+    if len(results) != expected or any(res.failed for res in results):
+        puts("osd.{0.osd_num} {0.osd_data_dev}: {1} FAILED".format(osd, stage))
+        return False
+
+    puts("osd.{0.osd_num} {0.osd_data_dev}: {1} done in {2:.1f}s".format(
+        osd, stage, etime - stime))
+    return True
 
 
 @task
@@ -445,7 +696,7 @@ def gather_ceph_config(conf_path):
 @task
 def radosgw_centos():
     sudo("yum -y install httpd mod_ssl openssl")
-    name = run("hostname -f")
+    name = get_facts()['hostname_fqdn']
 
     text = "ServerName " + name + "\n"
     text += "<IfModule !proxy_fcgi_module>\n"
@@ -499,8 +750,7 @@ def radosgw_centos():
     # sudo chown apache:apache /var/log/radosgw/client.radosgw.gateway.log
     # Distribute the keyring to the node with the gateway instance.
 
-    for cmd in prepare_cmds(cmds):
-        run(cmd)
+    run_script(prepare_cmds(cmds))
 
     cfg = """
     [client.radosgw.gateway]
@@ -558,46 +808,131 @@ def radosgw_centos():
     # run("swift -A http://{0}/auth/1.0 -U testuser:swift -K '{1}' list".format(name, key))
 
 
+@task
+def ramp_registered_osds(osd_ids, osd_weight, ramp, weights=None,
+                         journal=None):
+    """ramp_osds for osd's, registered according to journal - osd's of
+    failed hosts are not in crush map"""
+    osd_ids = registered_osds(osd_ids, journal)
+    if osd_ids:
+        ramp_osds(osd_ids, osd_weight, ramp, weights)
+
+
+def install_dag(inv, cfg, hosts_file, journal=None, preflight_path=None):
+    """all nodes are prepared in parallel, osd hosts wait only for
+    own preparation, config from first monitor and osd id reservation
+    (and disk preflight of all osd hosts, if enabled)"""
+    dag = DAG(max_parallel=cfg.get('max_parallel', 16),
+              max_per_host=cfg.get('max_per_host', 1),
+              journal=journal)
+
+    first_mon = cfg['mons'][0]
+    mon_ip = hosts_file[first_mon]
+
+    for host in set(cfg['mons']) | set(cfg['osd']):
+        dag.add("prepare:" + host, prepare_node, cfg['ceph_release'],
+                hosts_file, cfg.get('pkg_cache_url'), host=host,
+                verify=node_prepared)
+
+    dag.add("mon:" + first_mon, deploy_first_mon, inv, mon_ip,
+            hosts_file, prepare=False, verify=mon_running,
+            host=first_mon, deps=["prepare:" + first_mon])
+
+    dag.add("osd_ids", reserve_osds, cfg['osd'], mon_ip, list(cfg['osd']),
+            deps=["mon:" + first_mon])
+
+    # read config and admin keyring once, push it to all osd nodes
+    dag.add("ceph_config", fetch_ceph_config, inv.params_class(first_mon),
+            host=first_mon, deps=["mon:" + first_mon], journaled=False)
+
+    for host in cfg['osd']:
+        dag.add("config:" + host, push_files, Ref("ceph_config"),
+                host=host, deps=["prepare:" + host], journaled=False)
+
+    # read-only disk probes, before any mkfs
+    weights = None
+    if cfg.get('osd_preflight', False):
+        host_devs = dict((host, [dev for dev, _ in get_osd_devs(osd_cfg)])
+                         for host, osd_cfg in cfg['osd'].items())
+        performance = cfg.get('osd_weight_mode', 'capacity') == 'performance'
+        weights = Ref(dag.add("preflight", run_preflight, host_devs,
+                              preflight_path, performance))
+
+    # osd's are journaled one by one inside add_new_osd
+    ramp = ramp_config(cfg.get('osd_ramp'))
+    for host in cfg['osd']:
+        dag.add("osd:" + host, add_new_osd, inv, hosts_file,
+                Ref("osd_ids"), prepare=False, journal=journal,
+                weights=weights, crush_batch=cfg.get('crush_batch', False),
+                external_ramp=ramp is not None, host=host,
+                deps=["config:" + host], journaled=False)
+
+    osd_steps = ["osd:" + host for host in cfg['osd']]
+
+    if cfg.get('crush_batch', False):
+        # osd's of failed hosts don't block placement of the rest, rerun
+        # adds osd's, registered since previous one, and keeps weights
+        dag.add("crush", apply_crush_map, Ref("osd_ids"),
+                0 if ramp else cfg['osd_weigth'],
+                cfg['crush_chooseleaf_type'],
+                None if ramp else weights, journal,
+                host=first_mon, deps=osd_steps, after_failed=True,
+                journaled=False)
+        osd_steps = ["crush"]
+
+    if ramp is not None:
+        dag.add("ramp", ramp_registered_osds, Ref("osd_ids"),
+                cfg['osd_weigth'], ramp, weights, journal,
+                host=first_mon, deps=osd_steps)
+
+    return dag
+
+
 if __name__ == "__main__":
     cmd = sys.argv[1]
     conf_path = sys.argv[2]
-    cfg = yaml.load(open(conf_path).read())
     env.user = 'koder'
 
-    hosts_file = {}
+    # 'resolve' recompiles inventory, re-resolving all hosts
+    inv = compile_inventory(conf_path, refresh=(cmd == 'resolve'))
+    cfg = inv.cfg
+    hosts_file = inv.hosts
+    journal = Journal(conf_path + ".journal")
 
-    for host in cfg['mons']:
-        print host
-        hosts_file[host] = socket.gethostbyname(host)
+    for host, ip in sorted(hosts_file.items()):
+        print host, ip
 
-    for host in cfg['osd']:
-        print host
-        hosts_file[host] = socket.gethostbyname(host)
+    if cmd == 'resolve':
+        sys.exit(0)
+
+    # install steps run in forked processes with own connections,
+    # only clear reuses connections of this process
+    pool_hosts = []
+    if cmd == 'clear':
+        pool_hosts = config_hosts(cfg) + [hosts_file[cfg['mons'][0]]]
+    install_pool(pool_hosts, max_sessions=cfg.get('max_ssh_sessions', 256))
+    pkg_cache = start_from_cfg(cfg)
 
     if cmd == 'clear':
 
         for host in cfg.get('rgw', "").split():
             execute(remove_radosgw, hosts=[host])
 
-        mon_hosts = [host.strip() for host in cfg['mons'].split()]
+        mon_hosts = [host.strip() for host in cfg['mons']]
         osd_hosts = [host.strip() for host in cfg['osd']]
 
         for host in set(osd_hosts + mon_hosts):
-            execute(clear_node, conf_path, hosts=[host])
+            execute(clear_node, inv, hosts=[host])
+
+        journal.clear()
     else:
         assert cmd == 'install'
-        first_mon = cfg['mons'][0]
-
-        execute(deploy_first_mon,
-                conf_path,
-                hosts_file[first_mon],
-                hosts_file,
-                hosts=[first_mon])
-
-        for host, _ in cfg['osd'].items():
-            execute(add_new_osd, conf_path, hosts_file, hosts=[host])
+        install_dag(inv, cfg, hosts_file, journal,
+                    conf_path + ".preflight").run()
 
         # for host in cfg['rgw'].split():
         #     execute(radosgw_centos, hosts=[host])
 
+    print_pool_stats()
+    print_cache_stats(pkg_cache)
     disconnect_all()
@@ -0,0 +1,143 @@
+"""
+Device inventory for glob-based storage configs
+
+Devices of storage nodes, configured with 'globs', are listed once on all
+nodes in parallel and stored in CONFIG.devices file. Later config loads
+reuse it; nodes are listed again only if their globs changed or on
+demand (rediscover=True, 'discover' command of swift scripts).
+
+Device classes (ssd, hdd, nvme) are taken from 'dev_classes' ({dev: class})
+or 'dev_class' (whole node) of storage node config, or detected on node
+from sysfs: nvme* devices are nvme, non-rotational are ssd, other - hdd.
+"""
+
+import os
+import json
+import time
+
+from tracing import run, execute
+
+from fabric.api import env, task, parallel
+from fabric.context_managers import hide
+
+
+def inventory_path(conf_path):
+    return conf_path + ".devices"
+
+
+@task
+@parallel
+def list_devices(host_globs):
+    globs = host_globs[env.host_string]
+    with hide('running', 'stdout'):
+        return [i.strip() for i in run("ls -1 " + " ".join(globs)).split()]
+
+
+dev_class_names = ['ssd', 'hdd', 'nvme']
+
+dev_class_script = """
+for dev in {0} ; do
+    name=$(basename $(readlink -f $dev))
+    rot=$(cat /sys/class/block/$name/queue/rotational 2>/dev/null || \\
+          cat /sys/class/block/$name/../queue/rotational 2>/dev/null || \\
+          echo 1)
+    echo $dev $name $rot
+done
+"""
+
+
+def dev_path(dev):
+    return dev if dev.startswith("/") else "/dev/" + dev
+
+
+@task
+@parallel
+def detect_classes(host_devs):
+    """{dev: class} of current host devices"""
+    devs = host_devs[env.host_string]
+    with hide('running', 'stdout'):
+        out = run(dev_class_script.format(" ".join(dev_path(dev)
+                                                   for dev in devs)))
+    classes = {}
+    for line, dev in zip(out.strip().split("\n"), devs):
+        _, name, rotational = line.split()
+        if name.startswith("nvme"):
+            classes[dev] = 'nvme'
+        elif rotational == '0':
+            classes[dev] = 'ssd'
+        else:
+            classes[dev] = 'hdd'
+    return classes
+
+
+def configured_class(node_config, dev):
+    """class of device from storage node config or None"""
+    by_dev = node_config.get('dev_classes', {})
+    for key in (dev, os.path.basename(dev)):
+        if key in by_dev:
+            return by_dev[key]
+    return node_config.get('dev_class')
+
+
+def get_dev_classes(nodes, cfg):
+    """{ip: {dev: class}} for all storage nodes, devices without class in
+    config are detected on nodes"""
+    classes = {}
+    unknown = {}
+    for node in nodes.storage:
+        node_config = cfg['storage_nodes'][node.name]
+        classes[node.ip] = {}
+        for dev in node.dev2dir:
+            dev_class = configured_class(node_config, dev)
+            if dev_class is None:
+                unknown.setdefault(node.ip, []).append(dev)
+            elif dev_class not in dev_class_names:
+                raise ValueError("Unknown class {0!r} of {1}:{2}".format(
+                    dev_class, node.name, dev))
+            else:
+                classes[node.ip][dev] = dev_class
+
+    if unknown:
+        found = execute(detect_classes, unknown, hosts=sorted(unknown))
+        for ip, dev_classes in found.items():
+            classes[ip].update(dev_classes)
+
+    return classes
+
+
+def load_inventory(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def store_inventory(path, inventory):
+    with open(path + ".tmp", "w") as fd:
+        json.dump(inventory, fd, indent=4, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+def get_devices(conf_path, host_globs, rediscover=False):
+    """returns {ip: [device]} for {ip: [glob]}"""
+    if not host_globs:
+        return {}
+
+    path = inventory_path(conf_path)
+    inventory = {} if rediscover else load_inventory(path)
+
+    stale = sorted(ip for ip, globs in host_globs.items()
+                   if inventory.get(ip, {}).get('globs') != globs)
+
+    if stale:
+        found = execute(list_devices,
+                        dict((ip, host_globs[ip]) for ip in stale),
+                        hosts=stale)
+        for ip in stale:
+            inventory[ip] = {'globs': host_globs[ip],
+                             'devs': found[ip],
+                             'time': time.time()}
+        store_inventory(path, inventory)
+
+    return dict((ip, [str(dev) for dev in inventory[ip]['devs']])
+                for ip in host_globs)
@@ -0,0 +1,193 @@
+"""
+Disk preflight for osd devices
+
+Runs before mkfs on all osd hosts in parallel and on devices of host one
+by one, so probes don't share controller bandwidth: reads capacity,
+rotational flag, nr_requests and scheduler from sysfs and makes short
+read-only probes, bounded by probe_timeout seconds each - sequential (dd
+with 4MiB direct reads) and random (4KiB direct reads at random offsets
+by one python process, see rand_reader).
+
+Crush weight of osd is its capacity in TiB. With performance weights
+(osd_weight_mode: performance) weight of device, slower than median of
+devices of the same kind (rotational or not), is reduced proportionally,
+but not below min_perf_factor of capacity weight.
+
+Results are stored in CONFIG.preflight and weights are passed to
+add_new_osd and apply_crush_map.
+"""
+
+import json
+
+from tracing import sudo, execute
+
+from fabric.api import env, task, parallel
+from fabric.context_managers import hide
+
+
+probe_timeout = 20
+seq_count = 64
+rand_count = 200
+min_perf_factor = 0.5
+
+# random 4KiB O_DIRECT reads, args: device, size, count, timeout.
+# Prints number of reads and time spent in ns
+rand_reader = """
+import io, os, sys, time, mmap, random
+dev, size, count, timeout = sys.argv[1:]
+blocks = int(size) // 4096
+buf = mmap.mmap(-1, 4096)
+ops = 0
+start = time.time()
+try:
+    dev_file = io.FileIO(os.open(dev, os.O_RDONLY | os.O_DIRECT))
+    while blocks and ops < int(count) and \\
+            time.time() - start < float(timeout):
+        dev_file.seek(random.randrange(blocks) * 4096)
+        dev_file.readinto(buf)
+        ops += 1
+except (IOError, OSError):
+    pass
+print("%d %d" % (ops, (time.time() - start) * 1e9))
+"""
+
+probe_script = """
+probe() {{
+    dev=$1
+    name=$(basename $(readlink -f $dev))
+    blk=/sys/class/block/$name
+    queue=$blk/queue
+    [ -d $queue ] || queue=$blk/../queue
+
+    size=$(( $(cat $blk/size 2>/dev/null || echo 0) * 512 ))
+    rot=$(cat $queue/rotational 2>/dev/null || echo 1)
+    nr=$(cat $queue/nr_requests 2>/dev/null || echo 0)
+    sched=$(sed -r 's/.*\\[(.*)\\].*/\\1/' $queue/scheduler 2>/dev/null)
+    sched=${{sched:-none}}
+
+    start=$(date +%s%N)
+    seq_bytes=$(timeout -s INT {timeout} dd if=$dev of=/dev/null bs=4M \\
+                count={seq_count} iflag=direct 2>&1 | awk '/bytes/ {{print $1}}')
+    seq_ns=$(( $(date +%s%N) - start ))
+
+    rand=$($python - $dev $size {rand_count} {timeout} <<'READER'
+{rand_reader}
+READER
+)
+
+    echo @@dev $dev $name $size $rot $nr $sched ${{seq_bytes:-0}} $seq_ns \\
+        ${{rand:-0 0}}
+}}
+
+python=$(command -v python || command -v python3)
+for dev in {devs} ; do
+    probe $dev
+done
+"""
+
+
+def to_int(val):
+    return int(val) if val.isdigit() else 0
+
+
+def parse_probe(out):
+    """{dev: metrics} from probe script output, malformed lines are
+    skipped, so their devices have no results"""
+    res = {}
+    for line in out.split("\n"):
+        fields = line.split()
+        if len(fields) != 11 or fields[0] != "@@dev":
+            continue
+        (dev, name, size, rot, nr_requests, sched, seq_bytes, seq_ns,
+         ops, rand_ns) = fields[1:]
+        size, nr_requests, seq_bytes, seq_ns, ops, rand_ns = map(
+            to_int, (size, nr_requests, seq_bytes, seq_ns, ops, rand_ns))
+        res[dev] = {'name': name,
+                    'size': size,
+                    'rotational': rot == '1',
+                    'nr_requests': nr_requests,
+                    'scheduler': sched,
+                    'seq_mbps': seq_bytes * 1000.0 / max(seq_ns, 1),
+                    'rand_iops': ops * 1e9 / max(rand_ns, 1)}
+    return res
+
+
+@task
+@parallel
+def probe_devices(host_devs):
+    """{dev: metrics} for devices of current host"""
+    script = probe_script.format(timeout=probe_timeout, seq_count=seq_count,
+                                 rand_count=rand_count,
+                                 rand_reader=rand_reader.strip(),
+                                 devs=" ".join(host_devs[env.host_string]))
+    with hide('running', 'stdout'):
+        out = sudo(script)
+    return parse_probe(out)
+
+
+def median(vals):
+    vals = sorted(vals)
+    return vals[len(vals) // 2]
+
+
+def osd_weights(results, performance=False):
+    """{host: {dev: crush weight}} for {host: {dev: metrics}}"""
+    by_kind = {}
+    for devs in results.values():
+        for metrics in devs.values():
+            by_kind.setdefault(metrics['rotational'], []).append(metrics)
+
+    medians = dict((kind, (median(item['seq_mbps'] for item in items),
+                           median(item['rand_iops'] for item in items)))
+                   for kind, items in by_kind.items())
+
+    weights = {}
+    for host, devs in results.items():
+        weights[host] = {}
+        for dev, metrics in devs.items():
+            weight = metrics['size'] / 1024.0 ** 4
+            if performance:
+                seq, iops = medians[metrics['rotational']]
+                factor = min(1.0,
+                             metrics['seq_mbps'] / seq if seq else 1.0,
+                             metrics['rand_iops'] / iops if iops else 1.0)
+                weight *= max(min_perf_factor, factor)
+            weights[host][dev] = round(weight, 4)
+    return weights
+
+
+def print_preflight(results, weights):
+    print "{0:>20} {1:>14} {2:>9} {3:>4} {4:>9} {5:>9} {6:>8}".format(
+        "host", "dev", "size,GiB", "rot", "seq,MB/s", "rand,iops", "weight")
+    for host in sorted(results):
+        for dev in sorted(results[host]):
+            metrics = results[host][dev]
+            print ("{0:>20} {1:>14} {2:>9.0f} {3:>4} {4:>9.1f} {5:>9.0f} " +
+                   "{6:>8.4f}").format(host, dev,
+                                       metrics['size'] / 1024.0 ** 3,
+                                       int(metrics['rotational']),
+                                       metrics['seq_mbps'],
+                                       metrics['rand_iops'],
+                                       weights[host][dev])
+
+
+def run_preflight(host_devs, store_path=None, performance=False):
+    """probe devices of all hosts, returns {host: {dev: crush weight}}
+
+    host_devs - {host: [dev, ...]}
+    """
+    results = execute(probe_devices, host_devs, hosts=sorted(host_devs))
+    for host, devs in host_devs.items():
+        missing = set(devs) - set(results[host])
+        if missing:
+            raise RuntimeError("No preflight results for {0} on {1}".format(
+                ", ".join(sorted(missing)), host))
+
+    weights = osd_weights(results, performance)
+    print_preflight(results, weights)
+
+    if store_path is not None:
+        with open(store_path, "w") as fd:
+            json.dump({'results': results, 'weights': weights}, fd,
+                      indent=4, sort_keys=True)
+    return weights
@@ -0,0 +1,196 @@
+"""
+Thread based alternative to fabric @parallel
+
+Fabric forks one process per host for @parallel tasks, so memory and
+process count grow with inventory. execute_threaded runs task for
+all hosts from one process with at most max_workers threads. Every thread
+sees own copy of fabric env changes (host_string, warn_only, ...) and
+output changes (hide/show), and all ssh sessions are taken from shared conn_pool connection pool.
+Threads start with values of thread-local objects, registered by
+inherit_local, copied from thread, which called execute.
+
+Set DEPLOY_EXECUTOR=threads to use it for all multi-host @parallel
+executes and DEPLOY_WORKERS to change max_workers (64 by default).
+"""
+
+import os
+import sys
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from fabric import state
+from fabric.utils import abort, _AttributeDict, _AliasDict
+from fabric.api import settings
+from fabric.network import to_dict
+from fabric.tasks import requires_parallel
+
+import conn_pool
+
+
+executor_type = os.environ.get("DEPLOY_EXECUTOR", "fork")
+max_workers = int(os.environ.get("DEPLOY_WORKERS", 64))
+
+_local = threading.local()
+_deleted = object()
+_inherited = []
+
+
+class ThreadLocalEnv(_AttributeDict):
+    """fabric env, where changes, made in executor threads, are visible
+    only in the same thread"""
+    overlay_name = 'env'
+
+    def overlay(self):
+        return getattr(_local, self.overlay_name, None)
+
+    def __getitem__(self, key):
+        overlay = self.overlay()
+        if overlay is not None and key in overlay:
+            if overlay[key] is _deleted:
+                raise KeyError(key)
+            return overlay[key]
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        overlay = self.overlay()
+        if overlay is None:
+            dict.__setitem__(self, key, value)
+        else:
+            overlay[key] = value
+
+    def __delitem__(self, key):
+        overlay = self.overlay()
+        if overlay is None:
+            dict.__delitem__(self, key)
+        elif key not in self:
+            raise KeyError(key)
+        else:
+            overlay[key] = _deleted
+
+    def __contains__(self, key):
+        overlay = self.overlay()
+        if overlay is not None and key in overlay:
+            return overlay[key] is not _deleted
+        return dict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            val = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return val
+
+    def update(self, *args, **kwargs):
+        for key, val in dict(*args, **kwargs).items():
+            self[key] = val
+
+    def first(self, *names):
+        for name in names:
+            value = self.get(name)
+            if value:
+                return value
+
+
+def inherit_local(local):
+    """copy attributes of threading.local object to executor threads"""
+    _inherited.append(local)
+
+
+class ThreadLocalOutput(ThreadLocalEnv, _AliasDict):
+    """fabric output levels, changed by hide/show, per executor thread"""
+    overlay_name = 'output'
+
+    def __setitem__(self, key, value):
+        if key in self.aliases:
+            for aliased in self.aliases[key]:
+                self[aliased] = value
+        else:
+            ThreadLocalEnv.__setitem__(self, key, value)
+
+
+def install_thread_env():
+    # _AttributeDict.__setattr__ would store __class__ as dict key
+    if not isinstance(state.env, ThreadLocalEnv):
+        object.__setattr__(state.env, '__class__', ThreadLocalEnv)
+    if not isinstance(state.output, ThreadLocalOutput):
+        object.__setattr__(state.output, '__class__', ThreadLocalOutput)
+
+
+def run_on_host(task, host, args, kwargs, warn_only, inherited):
+    _local.env = {}
+    _local.output = {}
+    for local, values in inherited:
+        local.__dict__.update(values)
+    # connection of host must not be evicted by other threads
+    conn_pool.get_pool().pin(host)
+    try:
+        with settings(**to_dict(host)):
+            return host, True, task(*args, **kwargs)
+    except BaseException as exc:
+        if not warn_only:
+            sys.stderr.write("[{0}] {1}\n".format(host,
+                                                   traceback.format_exc()))
+        return host, False, exc
+    finally:
+        conn_pool.get_pool().unpin(host)
+        del _local.env
+        del _local.output
+
+
+def execute_threaded(task, *args, **kwargs):
+    """execute task on all hosts, returns {host: result}
+
+    like fabric, with env.warn_only exceptions are returned as results
+    of failed hosts, else execution is aborted, if any host failed
+    """
+    hosts = kwargs.pop('hosts')
+    warn_only = state.env.warn_only
+
+    install_thread_env()
+    if conn_pool.get_pool() is None:
+        conn_pool.install_pool()
+
+    workers = min(max_workers, len(hosts))
+    inherited = [(local, dict(local.__dict__)) for local in _inherited]
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(lambda host: run_on_host(task, host, args,
+                                                    kwargs, warn_only,
+                                                    inherited),
+                           hosts, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [host for host, ok, _ in results if not ok]
+    if failed and not warn_only:
+        abort("One or more hosts failed while executing task '{0}': {1}"
+              .format(getattr(task, 'name', task), ", ".join(failed)))
+
+    return dict((host, res) for host, _, res in results)
+
+
+def execute(task, *args, **kwargs):
+    hosts = kwargs.get('hosts')
+    if executor_type == 'threads' and hosts is not None and len(hosts) > 1 \
+            and not kwargs.get('roles') and requires_parallel(task):
+        return execute_threaded(task, *args, **kwargs)
+    return conn_pool.execute(task, *args, **kwargs)
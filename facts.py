@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import base64
+
+from tracing import run, execute
+from fabric.api import env, task, parallel
+from fabric.context_managers import hide
+
+
+facts_dir = os.path.expanduser("~/.deploy_facts")
+facts_ttl = int(os.environ.get("DEPLOY_FACTS_TTL", 3600))
+facts_version = 3
+
+# all facts are collected by one remote call, every section starts
+# with '@@name' line
+facts_script = """
+echo @@distro
+if [ -f /etc/redhat-release ] ; then echo rh ; else echo ubuntu ; fi
+echo @@hostname
+hostname
+echo @@hostname_short
+hostname -s
+echo @@hostname_fqdn
+hostname -f
+echo @@ips
+/sbin/ip -4 -o addr show scope global | awk '{gsub(/\\/.*/,"",$4); print $4}'
+echo @@cores
+nproc
+echo @@mem
+awk '/^MemTotal:/ {print $2}' /proc/meminfo
+echo @@nics
+for nic in /sys/class/net/* ; do
+    if [ -e $nic/device ] ; then
+        echo $(basename $nic) $(cat $nic/speed 2>/dev/null || echo -1)
+    fi
+done
+"""
+
+# block devices and mounts change with mkfs/mount, so they are read on
+# every storage_state call and never cached
+storage_script = """
+echo @@block_devs
+for dev in /sys/block/* ; do
+    echo $(basename $dev) $(cat $dev/size) $(cat $dev/queue/rotational)
+done
+echo @@mounts
+cat /proc/mounts
+"""
+
+
+def parse_sections(out):
+    sections = {}
+    curr = None
+
+    for line in out.split("\n"):
+        line = line.strip()
+        if line.startswith("@@"):
+            curr = sections.setdefault(line[2:], [])
+        elif line != "" and curr is not None:
+            curr.append(line)
+    return sections
+
+
+def parse_facts(out):
+    sections = parse_sections(out)
+    facts = {
+        'distro': sections['distro'][0],
+        'hostname': sections['hostname'][0],
+        'hostname_short': sections['hostname_short'][0],
+        'hostname_fqdn': sections['hostname_fqdn'][0],
+        'ips': sections.get('ips', []),
+        'cores': int(sections['cores'][0]),
+        'mem': int(sections['mem'][0]) * 1024,
+        'nics': {},
+        'version': facts_version,
+    }
+
+    # speed in Mb/s, None if unknown (link down, virtual nic)
+    for line in sections.get('nics', []):
+        name, speed = line.split()
+        facts['nics'][name] = int(speed) if int(speed) > 0 else None
+
+    return facts
+
+
+def parse_storage_state(out):
+    sections = parse_sections(out)
+    state = {'block_devs': {}, 'mounts': []}
+
+    for line in sections.get('block_devs', []):
+        name, sectors, rotational = line.split()
+        state['block_devs'][name] = {'size': int(sectors) * 512,
+                                     'rotational': rotational == '1'}
+
+    for line in sections.get('mounts', []):
+        dev, path, fs_type = line.split()[:3]
+        state['mounts'].append([dev, path, fs_type])
+
+    return state
+
+
+def facts_path(host):
+    return os.path.join(facts_dir, host.replace("/", "_") + ".json")
+
+
+_facts_cache = {}
+
+
+def get_facts(refresh=False):
+    """facts for current host, from memory or on-disk cache if
+    they are not older than facts_ttl"""
+    host = env.host_string
+
+    if not refresh and host in _facts_cache:
+        return _facts_cache[host]
+
+    fpath = facts_path(host)
+    facts = None
+    if not refresh and os.path.exists(fpath) and \
+            os.stat(fpath).st_mtime + facts_ttl > time.time():
+        facts = json.load(open(fpath))
+        if facts.get('version') != facts_version:
+            facts = None
+
+    if facts is None:
+        script = base64.b64encode(facts_script)
+        with hide('running', 'stdout'):
+            out = run("echo {0} | base64 -d | bash".format(script))
+        facts = parse_facts(out)
+
+        if not os.path.isdir(facts_dir):
+            try:
+                os.makedirs(facts_dir)
+            except OSError:
+                # created by other process
+                if not os.path.isdir(facts_dir):
+                    raise
+
+        tmp_path = "{0}.{1}".format(fpath, os.getpid())
+        with open(tmp_path, "w") as fd:
+            json.dump(facts, fd)
+        os.rename(tmp_path, fpath)
+
+    _facts_cache[host] = facts
+    return facts
+
+
+def storage_state():
+    """block devices and mounts of current host, read from host on
+    every call"""
+    with hide('running', 'stdout'):
+        out = run("echo {0} | base64 -d | bash".format(
+            base64.b64encode(storage_script)))
+    return parse_storage_state(out)
+
+
+@task
+@parallel
+def refresh_facts():
+    return get_facts(refresh=True)
+
+
+@task
+@parallel
+def host_facts():
+    return get_facts()
+
+
+def gather_facts(hosts):
+    """{host: facts} for all hosts, only hosts without fresh cached facts
+    are asked"""
+    return execute(host_facts, hosts=list(hosts))
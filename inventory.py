@@ -0,0 +1,124 @@
+import os
+import copy
+import time
+import socket
+import pickle
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+import yaml
+
+
+inventory_dir = os.path.expanduser("~/.deploy_inventory")
+# resolved ip's are re-checked after ttl even if yaml is unchanged
+inventory_ttl = int(os.environ.get("DEPLOY_INVENTORY_TTL", 3600))
+resolve_threads = 32
+# bump on Inventory format change to invalidate cached inventories
+inventory_version = 1
+
+
+class Inventory(object):
+    """compiled deployment config
+
+    cfg - parsed yaml
+    hosts - {hostname: ip} for all hosts, mentioned in config
+    params - {hostname: {param: value}} - config values, with all
+             formattable *_path values formatted for this host
+    """
+    def __init__(self, path, content_hash, cfg, hosts, params):
+        self.path = path
+        self.content_hash = content_hash
+        self.cfg = cfg
+        self.hosts = hosts
+        self.params = params
+
+    def host_params(self, hostname):
+        if hostname not in self.params:
+            return make_host_params(self.cfg, self.hosts, hostname)
+        return copy.deepcopy(self.params[hostname])
+
+    def params_class(self, hostname):
+        """host parameters as class attributes, format-friendly"""
+        class Params(object):
+            locals().update(self.host_params(hostname))
+        return Params
+
+
+def config_hosts(cfg):
+    hosts = list(cfg.get('mons', []))
+    hosts.extend(cfg.get('osd', {}).keys())
+    hosts.extend(cfg.get('rgw', "").split())
+    return sorted(set(hosts))
+
+
+def resolve_hosts(names, static_hosts=None):
+    static_hosts = static_hosts or {}
+    to_resolve = [name for name in names if name not in static_hosts]
+
+    hosts = dict(static_hosts)
+    if to_resolve:
+        pool = ThreadPool(min(resolve_threads, len(to_resolve)))
+        try:
+            ips = pool.map(socket.gethostbyname, to_resolve)
+        finally:
+            pool.close()
+        hosts.update(zip(to_resolve, ips))
+
+    return hosts
+
+
+def make_host_params(cfg, hosts, hostname):
+    class Params(object):
+        locals().update(cfg)
+
+    Params.hostname = hostname
+    if 'mons' in cfg:
+        Params.first_mon_ip = hosts[cfg['mons'][0]]
+
+    for name, val in cfg.items():
+        if name.endswith('_path') and isinstance(val, basestring):
+            try:
+                setattr(Params, name, val.format(Params))
+            except AttributeError:
+                # depends on per-osd values, like osd_num
+                pass
+
+    return dict((name, val) for name, val in vars(Params).items()
+                if not name.startswith('__'))
+
+
+def compile_inventory(path, refresh=False):
+    """parse yaml, resolve all hosts and compute per-host parameters
+
+    result is cached in inventory_dir by yaml content hash for
+    inventory_ttl seconds, refresh forces recompilation
+    """
+    data = open(path).read()
+    content_hash = hashlib.sha1(data).hexdigest()
+    cache_name = "{0}-{1}.pickle".format(content_hash, inventory_version)
+    cache_path = os.path.join(inventory_dir, cache_name)
+
+    if not refresh and os.path.exists(cache_path) and \
+            os.stat(cache_path).st_mtime + inventory_ttl > time.time():
+        with open(cache_path, "rb") as fd:
+            return pickle.load(fd)
+
+    cfg = yaml.load(data)
+    hosts = resolve_hosts(config_hosts(cfg), cfg.get('static_hosts'))
+    params = dict((hostname, make_host_params(cfg, hosts, hostname))
+                  for hostname in hosts)
+    inv = Inventory(path, content_hash, cfg, hosts, params)
+
+    if not os.path.isdir(inventory_dir):
+        try:
+            os.makedirs(inventory_dir)
+        except OSError:
+            if not os.path.isdir(inventory_dir):
+                raise
+
+    tmp_path = "{0}.{1}".format(cache_path, os.getpid())
+    with open(tmp_path, "wb") as fd:
+        pickle.dump(inv, fd)
+    os.rename(tmp_path, cache_path)
+
+    return inv
@@ -0,0 +1,58 @@
+import os
+import json
+import time
+import fcntl
+import contextlib
+
+
+class Journal(object):
+    """persistent record of completed deployment steps
+
+    {step_key: {'time': ..., other step inputs/results}}, stored as json.
+    Safe to update from several processes at once.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.path + ".lock", "a") as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as fd:
+            return json.load(fd)
+
+    def store(self, data):
+        tmp_path = "{0}.{1}".format(self.path, os.getpid())
+        with open(tmp_path, "w") as fd:
+            json.dump(data, fd, indent=4, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def get(self, key):
+        with self.locked():
+            return self.load().get(key)
+
+    def record(self, key, **data):
+        data['time'] = time.time()
+        with self.locked():
+            records = self.load()
+            records[key] = data
+            self.store(records)
+
+    def forget(self, key):
+        with self.locked():
+            records = self.load()
+            records.pop(key, None)
+            self.store(records)
+
+    def clear(self):
+        for path in (self.path, self.path + ".lock"):
+            if os.path.exists(path):
+                os.unlink(path)
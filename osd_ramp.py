@@ -0,0 +1,243 @@
+"""
+Gradual crush weight ramp for new osd's
+
+With 'osd_ramp' in config new osd's are added to crush map with weight 0
+and then raised to target weight in steps
+
+    osd_ramp:
+        step: 0.25          # share of target weight per step
+        batch: 4            # osd's, reweighted at once
+        max_backfills: 16   # max pg's, moving at once
+        poll_interval: 30
+        step_timeout: 86400
+
+Before every batch pg's in backfill/recovery states are counted and batch
+is sized, so that they and pg's, expected to move by batch (by pg's per
+crush weight from 'ceph osd df'), are at most max_backfills; osd, which
+doesn't fit the rest of budget, waits for no moving pg's, and steps are
+made smaller, if osd doesn't fit whole budget. After every step cluster
+must return to all pg's active+clean.
+
+All cluster commands go through runner (fabric run by default), which
+returns command output, so ramp can be driven by SimulatedCluster
+
+    $ python osd_ramp.py simulate [OSD_COUNT [WEIGHT]]
+"""
+
+import sys
+import json
+import math
+import time
+
+from tracing import run
+
+from fabric.utils import abort, puts
+
+
+default_ramp = {'step': 0.25,
+                'batch': 4,
+                'max_backfills': 16,
+                'poll_interval': 30,
+                'step_timeout': 24 * 3600}
+
+moving_states = ('backfill', 'recover')
+
+
+def ramp_config(ramp):
+    """ramp settings from 'osd_ramp' config value or None, if ramp is off"""
+    if not ramp:
+        return None
+    res = dict(default_ramp)
+    if isinstance(ramp, dict):
+        res.update(ramp)
+    return res
+
+
+def ramp_steps(target, step):
+    """weights of every step, last one is target"""
+    count = max(1, int(round(1.0 / step)))
+    return [target * pos / count for pos in range(1, count + 1)]
+
+
+def pg_status(runner):
+    """(moving pg's, all pg's are active+clean)"""
+    status = json.loads(runner("ceph status -f json"))
+    pgmap = status['pgmap']
+    moving = 0
+    clean = 0
+    for item in pgmap.get('pgs_by_state', []):
+        if any(state in item['state_name'] for state in moving_states):
+            moving += item['count']
+        if item['state_name'] == 'active+clean':
+            clean += item['count']
+    return moving, clean == pgmap['num_pgs']
+
+
+def osd_df(runner):
+    """({osd_num: crush weight}, pg's per unit of crush weight, i.e.
+    expected to move by unit of weight change)"""
+    nodes = json.loads(runner("ceph osd df -f json"))['nodes']
+    weights = dict((node['id'], float(node['crush_weight']))
+                   for node in nodes)
+    total = sum(weights.values())
+    if not total:
+        return weights, 0.0
+    return weights, sum(node['pgs'] for node in nodes) / total
+
+
+def fit_batch(osds, costs, budget, max_batch):
+    """leading osd's, which costs fit budget, at least one"""
+    batch = []
+    expected = 0
+    for osd_num in osds[:max_batch]:
+        if batch and expected + costs[osd_num] > budget:
+            break
+        batch.append(osd_num)
+        expected += costs[osd_num]
+    return batch, expected
+
+
+def wait_for(check, ramp, runner, sleep, what):
+    """poll pg status, until check(moving, clean) is true, returns moving"""
+    deadline = time.time() + ramp['step_timeout']
+    while True:
+        moving, clean = pg_status(runner)
+        if check(moving, clean):
+            return moving
+        if time.time() > deadline:
+            abort("Timeout waiting for {0}, {1} pg's are moving".format(
+                what, moving))
+        sleep(ramp['poll_interval'])
+
+
+def reweight(osd_weights, runner):
+    runner(" && ".join("ceph osd crush reweight osd.{0} {1:.4f}".format(
+        osd_num, weight) for osd_num, weight in osd_weights))
+
+
+def ramp_osds(osd_ids, osd_weight, ramp, weights=None, runner=run,
+              sleep=time.sleep):
+    """raise crush weight of all osd's from osd_ids to osd_weight or to
+    their weight from weights
+
+    Ramp resumes from current crush weights: osd is reweighted only by
+    steps above its current weight, so rerun after abort doesn't move
+    data back.
+
+    osd_ids - {hostname: [(storage_dev, osd_num, osd_uuid), ...]}
+    weights - {hostname: {storage_dev: weight}}
+    """
+    weights = weights or {}
+    targets = {}
+    for host, host_osds in osd_ids.items():
+        for dev, osd_num, _ in host_osds:
+            targets[osd_num] = float(weights.get(host, {}).get(dev,
+                                                               osd_weight))
+
+    osds = sorted(targets)
+    max_backfills = ramp['max_backfills']
+    current, per_weight = osd_df(runner)
+    current = dict((osd_num, current.get(osd_num, 0.0)) for osd_num in osds)
+    step = ramp['step']
+
+    # steps are made smaller, if single osd step doesn't fit budget
+    max_cost = max(targets.values() or [0]) * per_weight
+    if max_cost > max_backfills:
+        step = min(step, 1.0 / math.ceil(max_cost / max_backfills))
+
+    for share in ramp_steps(1.0, step):
+        # osd's, which are below this step
+        pending = [osd_num for osd_num in osds
+                   if round(targets[osd_num] * share, 4) >
+                   round(current[osd_num], 4)]
+        if not pending:
+            continue
+        costs = dict((osd_num, (targets[osd_num] * share - current[osd_num]) *
+                      per_weight) for osd_num in pending)
+        while pending:
+            moving = wait_for(lambda moving, clean: moving < max_backfills,
+                              ramp, runner, sleep, "backfill budget")
+            batch, expected = fit_batch(pending, costs,
+                                        max_backfills - moving, ramp['batch'])
+            if moving and moving + expected > max_backfills:
+                # single osd over rest of budget
+                wait_for(lambda moving, clean: moving == 0,
+                         ramp, runner, sleep, "backfill budget")
+                continue
+            reweight([(osd_num, targets[osd_num] * share)
+                      for osd_num in batch], runner)
+            for osd_num in batch:
+                current[osd_num] = targets[osd_num] * share
+            pending = pending[len(batch):]
+
+        wait_for(lambda moving, clean: clean and moving == 0,
+                 ramp, runner, sleep, "recovery")
+        puts("osd's {0} are at {1:.0f}% of weight, cluster is clean".format(
+            ",".join(map(str, osds)), share * 100))
+
+
+class SimulatedCluster(object):
+    """stand-in for cluster commands: every reweight puts pg's, proportional
+    to weight change, into backfill, every status poll completes some.
+    Osd's 0..osd_count-1 are new ones, existing ones follow them"""
+    def __init__(self, osd_count, existing=12, pg_num=1024,
+                 pgs_per_weight=64, backfill_rate=8):
+        self.weights = dict((osd_num, 0.0) for osd_num in range(osd_count))
+        self.weights.update((osd_num, 1.0) for osd_num in
+                            range(osd_count, osd_count + existing))
+        self.pg_num = pg_num
+        self.pgs_per_weight = pgs_per_weight
+        self.backfill_rate = backfill_rate
+        self.moving = 0
+        self.max_moving = 0
+        self.log = []
+
+    def __call__(self, cmd):
+        self.log.append(cmd)
+        if cmd == "ceph status -f json":
+            return self.status()
+        if cmd == "ceph osd df -f json":
+            return self.osd_df()
+
+        for part in cmd.split(" && "):
+            _, _, _, _, osd, weight = part.split()
+            osd_num = int(osd.split(".")[1])
+            delta = abs(float(weight) - self.weights[osd_num])
+            self.weights[osd_num] = float(weight)
+            self.moving += int(delta * self.pgs_per_weight)
+        self.moving = min(self.moving, self.pg_num)
+        self.max_moving = max(self.max_moving, self.moving)
+        return ""
+
+    def status(self):
+        states = []
+        if self.moving:
+            states.append({'state_name': 'active+remapped+backfilling',
+                           'count': self.moving})
+        states.append({'state_name': 'active+clean',
+                       'count': self.pg_num - self.moving})
+        self.moving = max(0, self.moving - self.backfill_rate)
+        return json.dumps({'pgmap': {'pgs_by_state': states,
+                                     'num_pgs': self.pg_num}})
+
+    def osd_df(self):
+        return json.dumps({'nodes': [
+            {'id': osd_num, 'crush_weight': weight,
+             'pgs': int(weight * self.pgs_per_weight)}
+            for osd_num, weight in sorted(self.weights.items())]})
+
+
+if __name__ == "__main__":
+    assert sys.argv[1] == 'simulate'
+    osd_count = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    weight = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+
+    cluster = SimulatedCluster(osd_count)
+    ramp = dict(default_ramp, poll_interval=0)
+    osd_ids = {'sim': [(None, osd_num, None) for osd_num in range(osd_count)]}
+    ramp_osds(osd_ids, weight, ramp, runner=cluster, sleep=lambda _: None)
+
+    polls = sum(1 for cmd in cluster.log if cmd == "ceph status -f json")
+    reweights = sum(1 for cmd in cluster.log if "crush reweight" in cmd)
+    print "{0} reweights, {1} status polls, max {2} pg's moving".format(
+        reweights, polls, cluster.max_moving)
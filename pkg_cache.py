@@ -0,0 +1,297 @@
+"""
+Package cache on admin node
+
+Caching http server, started by deploy scripts on admin node, when
+pkg_cache_url is set in config. Repo definitions on nodes are rewritten
+to get packages through it
+
+    http://ceph.com/rpm-hammer/el7/x86_64 => PKG_CACHE_URL/http/ceph.com/rpm-hammer/el7/x86_64
+
+so every file is downloaded from internet once and then served to all
+nodes from pkg_cache_dir. Repo metadata is re-downloaded, if it's older
+than meta_ttl. In offline mode (pkg_cache_offline: true) nothing is
+downloaded, cache dir can be pre-populated from bundle (pkg_cache_bundle),
+made after online deployment
+
+    $ python pkg_cache.py bundle ~/.deploy_pkg_cache /tmp/pkg_bundle.tar.gz
+
+Only files under cache dir are served and only hosts from allow-list
+(pkg_cache_hosts, default_upstreams if not set) are fetched from. Server
+listens on address of pkg_cache_url only.
+
+Server can also be started standalone
+
+    $ python pkg_cache.py serve ~/.deploy_pkg_cache 192.168.152.1:8090 [offline]
+"""
+
+import os
+import sys
+import time
+import shutil
+import urllib2
+import hashlib
+import tarfile
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+
+cache_dir = os.path.expanduser("~/.deploy_pkg_cache")
+meta_ttl = 3600
+chunk_size = 1 << 20
+
+# package repos of ceph and RDO and their dependencies
+default_upstreams = ['ceph.com',
+                     'download.ceph.com',
+                     'gitbuilder.ceph.com',
+                     'rdo.fedorapeople.org',
+                     'repos.fedorapeople.org',
+                     'mirror.centos.org',
+                     'buildlogs.centos.org',
+                     'dl.fedoraproject.org',
+                     'download.fedoraproject.org']
+
+
+def mirror_url(cache_url, url):
+    """url of upstream url in cache, or url itself, if cache is not used"""
+    if not cache_url:
+        return url
+    scheme, rest = url.split("://", 1)
+    return "{0}/{1}/{2}".format(cache_url.rstrip("/"), scheme, rest)
+
+
+def rewrite_repos_cmd(cache_url, repo_files):
+    """shell command, which redirects baseurl's of yum repo files to cache"""
+    return "sed -i -r 's|^baseurl=(https?)://|baseurl={0}/\\1/|' {1}".format(
+        cache_url.rstrip("/"), repo_files)
+
+
+def is_metadata(path):
+    return '/repodata/' in path or '/dists/' in path
+
+
+class CacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def local_path(self):
+        """(upstream url, cache file) for request path or (None, None),
+        if path is malformed or points outside of cache dir"""
+        if not self.path.startswith("/"):
+            return None, None
+
+        parts = self.path[1:].split("/", 2)
+        if len(parts) != 3 or parts[0] not in ('http', 'https'):
+            return None, None
+
+        scheme, host, rest = parts
+        path, _, query = rest.partition("?")
+        segments = path.split("/")
+        bad_segments = [seg for seg in segments[:-1] if seg in ("", ".", "..")]
+        if host in ("", ".", "..") or bad_segments or \
+                segments[-1] in (".", ".."):
+            return None, None
+
+        fname = os.path.join(self.server.root, scheme, host, *segments)
+        if segments[-1] == "":
+            fname = os.path.join(fname, "@index")
+        if query:
+            fname += "@" + hashlib.sha1(query).hexdigest()[:16]
+
+        root = os.path.realpath(self.server.root)
+        if not os.path.realpath(fname).startswith(root + os.sep):
+            return None, None
+
+        return "{0}://{1}/{2}".format(scheme, host, rest), fname
+
+    def host_allowed(self, url):
+        host = urlparse.urlparse(url).hostname
+        return host in self.server.upstreams
+
+    def fetch(self, url, fname):
+        dname = os.path.dirname(fname)
+        if not os.path.isdir(dname):
+            try:
+                os.makedirs(dname)
+            except OSError:
+                if not os.path.isdir(dname):
+                    raise
+
+        tmp_name = "{0}.{1}.{2}.tmp".format(fname, os.getpid(),
+                                           threading.current_thread().ident)
+        src = urllib2.urlopen(url, timeout=60)
+        try:
+            with open(tmp_name, "wb") as fd:
+                shutil.copyfileobj(src, fd, chunk_size)
+        finally:
+            src.close()
+
+        self.server.fetched += os.path.getsize(tmp_name)
+        os.rename(tmp_name, fname)
+
+    def need_fetch(self, fname):
+        if self.server.offline:
+            return False
+        if not os.path.isfile(fname):
+            return True
+        return is_metadata(fname) and \
+            time.time() - os.path.getmtime(fname) > self.server.meta_ttl
+
+    def get_file(self, url, fname):
+        with self.server.lock_for(fname):
+            if not self.need_fetch(fname):
+                found = os.path.isfile(fname)
+                if found:
+                    self.server.hits += 1
+                return found
+
+            self.server.misses += 1
+            try:
+                self.fetch(url, fname)
+            except (urllib2.URLError, IOError, OSError) as exc:
+                self.log_error("Can't fetch %s: %s", url, exc)
+
+            # stale metadata is better than nothing
+            return os.path.isfile(fname)
+
+    def send_file(self, with_body):
+        url, fname = self.local_path()
+        if url is None:
+            self.send_error(400, "Expected /SCHEME/HOST/PATH")
+            return
+
+        if not self.host_allowed(url):
+            self.send_error(403, "Upstream host is not allowed: " + url)
+            return
+
+        if not self.get_file(url, fname):
+            self.send_error(404, "Not found in cache: " + url)
+            return
+
+        with open(fname, "rb") as fd:
+            self.send_response(200)
+            self.send_header("Content-Length", str(os.path.getsize(fname)))
+            self.send_header("Content-Type", "application/octet-stream")
+            self.end_headers()
+            if with_body:
+                shutil.copyfileobj(fd, self.wfile, chunk_size)
+
+    def do_GET(self):
+        self.send_file(True)
+
+    def do_HEAD(self):
+        self.send_file(False)
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, address, port, offline=False, verbose=False,
+                 upstreams=default_upstreams):
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port),
+                                           CacheHandler)
+        self.root = root
+        self.upstreams = set(upstreams)
+        self.offline = offline
+        self.verbose = verbose
+        self.meta_ttl = meta_ttl
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def lock_for(self, fname):
+        with self.locks_lock:
+            return self.locks.setdefault(fname, threading.Lock())
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'fetched_mb': self.fetched / 1024.0 ** 2}
+
+
+def safe_member(member, root):
+    """only regular files and directories, which stay inside root"""
+    if not (member.isfile() or member.isdir()):
+        return False
+    if member.name.startswith("/") or '..' in member.name.split("/"):
+        return False
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, member.name))
+    return path == root or path.startswith(root + os.sep)
+
+
+def unpack_bundle(bundle, root):
+    """extract bundle into root, all members are checked before any
+    of them is extracted"""
+    with tarfile.open(bundle) as tar:
+        members = tar.getmembers()
+        for member in members:
+            if not safe_member(member, root):
+                raise ValueError("Bad file {0!r} in bundle {1}".format(
+                    member.name, bundle))
+        tar.extractall(root, members)
+
+
+def make_bundle(root, bundle):
+    with tarfile.open(bundle, "w:gz") as tar:
+        for name in sorted(os.listdir(root)):
+            tar.add(os.path.join(root, name), arcname=name)
+
+
+def start_cache_server(root, address, port, offline=False, bundle=None,
+                       upstreams=default_upstreams):
+    """start cache server in background thread of current process"""
+    if not os.path.isdir(root):
+        os.makedirs(root)
+
+    if bundle is not None:
+        unpack_bundle(bundle, root)
+
+    server = CacheServer(root, address, port, offline=offline,
+                         upstreams=upstreams)
+    th = threading.Thread(target=server.serve_forever)
+    th.daemon = True
+    th.start()
+    return server
+
+
+def start_from_cfg(cfg):
+    """start cache server, if config has pkg_cache_url, else return None"""
+    url = cfg.get('pkg_cache_url')
+    if not url:
+        return None
+
+    root = os.path.expanduser(cfg.get('pkg_cache_dir', cache_dir))
+    bundle = cfg.get('pkg_cache_bundle')
+    if bundle is not None:
+        bundle = os.path.expanduser(bundle)
+
+    parsed = urlparse.urlparse(url)
+    return start_cache_server(root, parsed.hostname, parsed.port or 80,
+                              offline=cfg.get('pkg_cache_offline', False),
+                              bundle=bundle,
+                              upstreams=cfg.get('pkg_cache_hosts',
+                                                default_upstreams))
+
+
+def print_cache_stats(server):
+    if server is not None:
+        print ("Package cache: {hits} hits, {misses} misses, " +
+               "{fetched_mb:.1f} MiB downloaded").format(**server.stats())
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == 'bundle':
+        make_bundle(os.path.expanduser(sys.argv[2]), sys.argv[3])
+    else:
+        assert sys.argv[1] == 'serve'
+        address, port = sys.argv[3].rsplit(":", 1)
+        offline = len(sys.argv) > 4 and sys.argv[4] == 'offline'
+        server = CacheServer(os.path.expanduser(sys.argv[2]), address,
+                             int(port), offline=offline, verbose=True)
+        server.serve_forever()
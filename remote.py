@@ -0,0 +1,209 @@
+"""
+Remote execution helpers, shared by ceph and swift deploy scripts
+"""
+
+import os
+import time
+import uuid
+import pipes
+import base64
+import hashlib
+from StringIO import StringIO
+
+from tracing import run, sudo, put
+
+from fabric.state import output
+from fabric.utils import abort, puts
+from fabric.context_managers import hide
+from fabric.api import parallel, env, task
+
+
+# larger scripts are uploaded, command line is limited by MAX_ARG_STRLEN
+max_inline_script = 64 * 1024
+
+
+@task
+@parallel
+def push_files(files):
+    """upload {remote_path: content} files, which differs from remote
+    copies, returns list of updated files"""
+    stime = time.time()
+    paths = sorted(files)
+    dirs = set(os.path.dirname(path) for path in paths)
+
+    with hide('running', 'stdout', 'warnings'):
+        out = sudo("mkdir -p {0} ; md5sum {1}".format(" ".join(dirs),
+                                                      " ".join(paths)),
+                   warn_only=True)
+
+    remote_md5 = {}
+    for line in out.split("\n"):
+        if len(line.split()) == 2:
+            md5, path = line.split()
+            remote_md5[path] = md5
+
+    updated = []
+    for path in paths:
+        if remote_md5.get(path) != hashlib.md5(files[path]).hexdigest():
+            put(remote_path=path, local_path=StringIO(files[path]),
+                use_sudo=True)
+            updated.append(path)
+
+    puts("{0} of {1} config files updated in {2:.2f}s".format(
+        len(updated), len(paths), time.time() - stime))
+    return updated
+
+
+@task
+@parallel
+def push_host_files(host_files):
+    """push_files with {host: {remote_path: content}}"""
+    return push_files(host_files[env.host_string])
+
+
+# Runs a set of command lists ("jobs") on the remote host in a single ssh
+# exec. Every step records its exit code, output and timings into a temporary
+# directory; a job stops on its first failed step. Up to {max_workers} jobs
+# run at the same time.
+script_templ = """
+_T=$(mktemp -d)
+
+_step() {{
+    local idx=$1
+    local stime=$(date +%s.%N)
+    bash -c "$2" </dev/null >$_T/$idx.out 2>$_T/$idx.err
+    local code=$?
+    echo "$idx $code $stime $(date +%s.%N)" >> $_T/res
+    return $code
+}}
+
+{jobs}
+
+_pids=()
+for _job in {job_ids}; do
+    _job_$_job &
+    _pids+=($!)
+    if [ ${{#_pids[@]}} -ge {max_workers} ]; then
+        wait ${{_pids[0]}}
+        _pids=("${{_pids[@]:1}}")
+    fi
+done
+wait
+
+touch $_T/res
+while read idx code stime etime; do
+    echo "@@STEP $idx $code $stime $etime"
+    echo "o:$(base64 -w0 $_T/$idx.out)"
+    echo "e:$(base64 -w0 $_T/$idx.err)"
+done < $_T/res
+rm -rf $_T
+exit 0
+"""
+
+
+class CmdResult(object):
+    def __init__(self, cmd, code, stdout, stderr, stime, etime):
+        self.cmd = cmd
+        self.code = code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.stime = stime
+        self.etime = etime
+
+    @property
+    def failed(self):
+        return self.code != 0
+
+    @property
+    def duration(self):
+        return self.etime - self.stime
+
+    def __str__(self):
+        return "{0!r} => {1} in {2:.2f}s".format(self.cmd, self.code,
+                                                  self.duration)
+
+
+def make_script(jobs, max_workers=1):
+    funcs = []
+    for job_idx, cmds in enumerate(jobs):
+        funcs.append("_job_{0}() {{".format(job_idx))
+        for cmd_idx, cmd in enumerate(cmds):
+            funcs.append("    _step {0}.{1} {2} || return 1".format(
+                job_idx, cmd_idx, pipes.quote(cmd)))
+        funcs.append("    return 0\n}")
+
+    return script_templ.format(jobs="\n".join(funcs),
+                               job_ids=" ".join(map(str, range(len(jobs)))),
+                               max_workers=max(1, max_workers))
+
+
+def parse_script_output(jobs, output):
+    results = [[] for _ in jobs]
+    lines = [line.strip() for line in output.split("\n")]
+
+    for pos, line in enumerate(lines):
+        if not line.startswith("@@STEP "):
+            continue
+
+        idx, code, stime, etime = line.split()[1:]
+        job_idx, cmd_idx = map(int, idx.split("."))
+
+        assert lines[pos + 1].startswith("o:")
+        assert lines[pos + 2].startswith("e:")
+
+        cmd_res = CmdResult(jobs[job_idx][cmd_idx],
+                            int(code),
+                            base64.b64decode(lines[pos + 1][2:]),
+                            base64.b64decode(lines[pos + 2][2:]),
+                            float(stime),
+                            float(etime))
+        results[job_idx].append((cmd_idx, cmd_res))
+
+    return [[cmd_res for _, cmd_res in sorted(job_res)]
+            for job_res in results]
+
+
+def run_jobs(jobs, max_workers=1, warn_only=False):
+    """run several command lists in one round trip, see script_templ
+
+    returns list of CmdResult lists, one per job. Steps after the first
+    failed step of a job are not executed and have no results.
+    Aborts after all jobs are finished if any of them failed,
+    unless warn_only is set
+    """
+    jobs = [[cmd for cmd in cmds if cmd.strip() != ""] for cmds in jobs]
+    script = make_script(jobs, max_workers)
+
+    with hide('running', 'stdout'):
+        if len(script) * 4 / 3 < max_inline_script:
+            out = run("echo {0} | base64 -d | bash".format(
+                base64.b64encode(script)))
+        else:
+            path = "/tmp/run_jobs-{0}.sh".format(uuid.uuid4().hex)
+            put(remote_path=path, local_path=StringIO(script))
+            out = run("bash {0} ; rm -f {0}".format(path))
+
+    results = parse_script_output(jobs, out)
+    failed = []
+
+    for job_idx, job_res in enumerate(results):
+        for res in job_res:
+            puts(str(res))
+            if output.stdout and res.stdout.strip() != "":
+                print res.stdout.rstrip()
+
+        if len(job_res) != len(jobs[job_idx]) or \
+           any(res.failed for res in job_res):
+            failed.append(job_idx)
+            if len(job_res) != 0 and job_res[-1].stderr.strip() != "":
+                print job_res[-1].stderr.rstrip()
+
+    if len(failed) != 0 and not warn_only:
+        abort("{0} of {1} command batches failed".format(len(failed),
+                                                         len(jobs)))
+
+    return results
+
+
+def run_script(cmds, warn_only=False):
+    return run_jobs([cmds], warn_only=warn_only)[0]
@@ -0,0 +1,609 @@
+"""
+Offline swift ring analyzer
+
+Simulates partition assignment for candidate part powers, replica counts
+and zone layouts over device inventory of storage nodes (device, node,
+zone, capacity), before any ring is built. For every candidate reports
+
+    * per-device balance - max over/under load vs. weight share, %
+    * hot disk skew - expected objects on most loaded disk vs. its fair
+      share: objects are spread over partitions by hash, so objects of
+      disk are Poisson distributed around its partition share, and the
+      hottest of N disks is ~sqrt(2 ln N) deviations above its mean
+    * dispersion - % of partitions with 2+ replicas in one zone/on one node,
+      while enough zones/nodes exist to avoid it
+    * partitions per device now and at max cluster size
+
+and recommends parameters. Assignment is tiered greedy (zone, node, device
+with most wanted partitions, other zones/nodes first), close to what swift
+RingBuilder does on first rebalance.
+
+Zone layouts: 'flat' - all devices in one zone, 'node' - zone per node,
+'config' - 'zone' keys of storage nodes (as rings are built).
+
+Inventory is collected by 'analyze_rings' command of swift scripts and
+stored in CONFIG.ring_devices, to re-run analysis offline
+
+    $ python ring_analyzer.py deployment_swift.yaml.ring_devices \
+        [MAX_DEVICES [OBJECTS]]
+
+Object count is 'expected_objects' config key, else used space of devices
+by avg_object_size, else default_objects_per_dev per device.
+
+Ring changes (new nodes, other weights) are estimated by diff of old and
+new inventories: rebalance moves only partition replicas above new share
+of device to devices below their share, so moved replicas per device and
+node, bytes (by used space of old devices) and replication time (by
+per-node replication MB/s) are projected. Change can be split into staged
+plan of gradual weight changes, each step moving at most max_step_share
+of all replicas and starting not earlier than min_part_hours and
+replication of previous step allow. Every ring (see rings.ring_specs) is
+estimated over its own devices, selected by 'class' of inventory devices
+
+    $ python ring_analyzer.py plan OLD_INVENTORY NEW_INVENTORY PART_POWER \
+        REPLICAS [MIN_PART_HOURS [REPLICATION_MBPS]]
+
+Inventory device may have 'weight' key (from 'weights' of storage node
+config), else weight is capacity. Rings are built with the same weights.
+"""
+
+import os
+import sys
+import json
+import math
+
+from tracing import run, execute
+from rings import ring_specs
+from devices import dev_path, get_dev_classes
+
+from fabric.api import env, task, parallel
+from fabric.utils import abort
+from fabric.context_managers import hide
+
+
+default_part_powers = range(10, 17)
+default_replicas = [2, 3]
+layouts = ['flat', 'node', 'config']
+
+# swift recommends at least 100 partitions per device at max cluster size
+min_parts_per_dev = 100
+max_balance = 1.0
+growth = 4
+
+# object count estimate for hot disk skew
+avg_object_size = 1024 ** 2
+default_objects_per_dev = 100000
+
+# share of all partition replicas, moved by one step of weight ramp
+max_step_share = 0.05
+default_replication_mbps = 100
+
+# ring spec of offline estimates, all inventory devices in one ring
+all_devices = [('all', None, None)]
+
+dev_size_script = """
+while read dev mount ; do
+    name=$(basename $(readlink -f $dev))
+    size=$(cat /sys/class/block/$name/size 2>/dev/null || echo 0)
+    used=0
+    if mountpoint -q $mount ; then
+        used=$(df -B1 --output=used $mount | tail -n 1)
+    fi
+    echo $dev $size $used
+done <<DEVS
+{0}
+DEVS
+"""
+
+
+@task
+@parallel
+def device_sizes(host_devs):
+    """{dev: (size, used)} in bytes of current host devices, used is
+    space used on mounted device"""
+    devs = host_devs[env.host_string]
+    with hide('running', 'stdout'):
+        out = run(dev_size_script.format("\n".join(
+            "{0} {1}".format(dev_path(dev), mount) for dev, mount in devs)))
+    sizes = {}
+    for line, (dev, _) in zip(out.strip().split("\n"), devs):
+        _, size, used = line.split()
+        sizes[dev] = (int(size) * 512, int(used))
+    return sizes
+
+
+def collect_inventory(nodes, cfg):
+    """[device dict] of all storage nodes, sizes are read from nodes.
+    If rings are split by device classes, devices have 'class' key"""
+    dev_classes = None
+    if any(classes is not None for _, _, classes in ring_specs(cfg)):
+        dev_classes = get_dev_classes(nodes, cfg)
+
+    host_devs = dict((node.ip, sorted(node.dev2dir.items()))
+                     for node in nodes.storage)
+    sizes = execute(device_sizes, host_devs, hosts=sorted(host_devs))
+
+    inventory = []
+    for node in nodes.storage:
+        node_cfg = cfg['storage_nodes'].get(node.name, {})
+        for dev in sorted(node.dev2dir):
+            size, used = sizes[node.ip][dev]
+            item = {'node': node.name,
+                    'ip': node.ip,
+                    'zone': node_cfg.get('zone'),
+                    'device': dev,
+                    'size': size,
+                    'used': used}
+            if dev in node_cfg.get('weights', {}):
+                item['weight'] = node_cfg['weights'][dev]
+            if dev_classes is not None:
+                item['class'] = dev_classes[node.ip][dev]
+            inventory.append(item)
+    return inventory
+
+
+def device_weight(dev):
+    """'weight' of device, if set, else capacity in GiB, 100 if capacity
+    is unknown"""
+    if 'weight' in dev:
+        return float(dev['weight'])
+    if not dev['size']:
+        return 100.0
+    return dev['size'] / 1024.0 ** 3
+
+
+def ring_weights(inventory):
+    """{ip: {dev: ring weight}} of inventory devices"""
+    weights = {}
+    for dev in inventory:
+        weights.setdefault(dev['ip'], {})[dev['device']] = \
+            round(device_weight(dev), 2)
+    return weights
+
+
+def layout_zones(inventory, layout):
+    """zone of every device for layout"""
+    if layout == 'flat':
+        return [1] * len(inventory)
+    if layout == 'node':
+        nodes = sorted(set(dev['node'] for dev in inventory))
+        return [nodes.index(dev['node']) + 1 for dev in inventory]
+    assert layout == 'config'
+    return [dev['zone'] or 1 for dev in inventory]
+
+
+def simulate(inventory, zones, part_power, replicas):
+    """assign replicas of all partitions, returns [parts per device] and
+    counts of partitions with shared zone/node"""
+    parts = 2 ** part_power
+    weights = [device_weight(dev) for dev in inventory]
+    total = sum(weights)
+    wanted = [weight / total * parts * replicas for weight in weights]
+    assigned = [0] * len(inventory)
+
+    # zone -> node -> [device index]
+    tree = {}
+    for pos, dev in enumerate(inventory):
+        tree.setdefault(zones[pos], {}).setdefault(dev['node'], []).append(pos)
+
+    node_wanted = dict((node, sum(wanted[pos] for pos in devs))
+                       for zone_nodes in tree.values()
+                       for node, devs in zone_nodes.items())
+    zone_wanted = dict((zone, sum(node_wanted[node] for node in zone_nodes))
+                       for zone, zone_nodes in tree.items())
+
+    zone_count = len(tree)
+    node_count = len(node_wanted)
+    zone_shared = node_shared = 0
+
+    for _ in range(parts):
+        used_zones = set()
+        used_devs = set()
+        node_used = dict.fromkeys(node_wanted, 0)
+
+        for _ in range(replicas):
+            best = None
+            for zone, zone_nodes in tree.items():
+                for node, devs in zone_nodes.items():
+                    if node_used[node] == len(devs):
+                        continue
+                    # prefer unused zones, then unused nodes, then wanted
+                    key = (zone not in used_zones, node_used[node] == 0,
+                           zone_wanted[zone], node_wanted[node])
+                    if best is None or key > best[0]:
+                        best = (key, zone, node)
+
+            if best is None:
+                break
+
+            _, zone, node = best
+            pos = max((pos for pos in tree[zone][node]
+                       if pos not in used_devs),
+                      key=lambda pos: wanted[pos])
+            assigned[pos] += 1
+            wanted[pos] -= 1
+            node_wanted[node] -= 1
+            zone_wanted[zone] -= 1
+            used_devs.add(pos)
+            used_zones.add(zone)
+            node_used[node] += 1
+
+        if len(used_zones) < min(replicas, zone_count):
+            zone_shared += 1
+        if sum(1 for count in node_used.values() if count) < \
+                min(replicas, node_count):
+            node_shared += 1
+
+    return assigned, zone_shared, node_shared
+
+
+def inventory_objects(inventory):
+    """object count by used space of devices"""
+    used = sum(dev.get('used', 0) for dev in inventory)
+    if used == 0:
+        return default_objects_per_dev * len(inventory)
+    return used / avg_object_size
+
+
+def hot_skew(assigned, wanted, objects, parts):
+    """expected objects on hottest device vs. its fair share. Objects of
+    device with n partition replicas ~ Poisson(n * objects / parts)"""
+    per_part = float(objects) / parts
+    devices = len(assigned)
+    deviations = math.sqrt(2 * math.log(devices)) if devices > 1 else 0.0
+    skew = 0.0
+    for count, fair in zip(assigned, wanted):
+        mean = count * per_part
+        if mean > 0:
+            skew = max(skew, (mean + deviations * math.sqrt(mean)) /
+                       (fair * per_part))
+    return skew
+
+
+def analyze_one(inventory, layout, part_power, replicas, max_devices,
+                objects):
+    zones = layout_zones(inventory, layout)
+    assigned, zone_shared, node_shared = simulate(inventory, zones,
+                                                  part_power, replicas)
+    parts = 2 ** part_power
+    weights = [device_weight(dev) for dev in inventory]
+    total = sum(weights)
+    wanted = [weight / total * parts * replicas for weight in weights]
+    loads = [float(count) / fair for count, fair in zip(assigned, wanted)]
+
+    return {'layout': layout,
+            'zones': len(set(zones)),
+            'replicas': replicas,
+            'part_power': part_power,
+            'overload': (max(loads) - 1) * 100,
+            'underload': (1 - min(loads)) * 100,
+            'hot_skew': hot_skew(assigned, wanted, objects, parts),
+            'zone_shared': zone_shared * 100.0 / parts,
+            'node_shared': node_shared * 100.0 / parts,
+            'min_parts': min(assigned),
+            'parts_at_max': parts * replicas / float(max_devices)}
+
+
+def analyze(inventory, part_powers=default_part_powers,
+            replica_counts=default_replicas, max_devices=None, objects=None):
+    """results for all candidates"""
+    if max_devices is None:
+        max_devices = len(inventory) * growth
+    if objects is None:
+        objects = inventory_objects(inventory)
+
+    has_zones = any(dev['zone'] for dev in inventory)
+    candidate_layouts = [layout for layout in layouts
+                         if layout != 'config' or has_zones]
+
+    return [analyze_one(inventory, layout, part_power, replicas, max_devices,
+                        objects)
+            for layout in candidate_layouts
+            for replicas in replica_counts
+            for part_power in part_powers]
+
+
+def growth_part_power(max_devices, replicas):
+    return int(math.ceil(math.log(max_devices * min_parts_per_dev /
+                                  float(replicas), 2)))
+
+
+def recommend(results, preferred_replicas=3):
+    """best result: good dispersion and balance, most failure domains,
+    replicas closest to preferred, smallest part power"""
+    def good(res):
+        return res['node_shared'] == 0 and \
+            res['overload'] <= max_balance and \
+            res['parts_at_max'] >= min_parts_per_dev
+
+    candidates = [res for res in results if good(res)]
+    if not candidates:
+        return min(results, key=lambda res: (res['node_shared'],
+                                             res['overload']))
+
+    return min(candidates,
+               key=lambda res: (res['zone_shared'], -res['zones'],
+                                abs(res['replicas'] - preferred_replicas),
+                                res['part_power']))
+
+
+report_templ = "{layout:>6} {zones:>5} {replicas:>8} {part_power:>10} " + \
+               "{overload:>8.2f} {underload:>9.2f} {hot_skew:>8.3f} " + \
+               "{zone_shared:>10.2f} {node_shared:>10.2f} " + \
+               "{min_parts:>9} {parts_at_max:>12.0f}"
+
+
+def print_report(inventory, results, best, max_devices):
+    sizes = [dev['size'] for dev in inventory]
+    print "{0} devices on {1} nodes, {2:.1f} TiB, up to {3} devices".format(
+        len(inventory), len(set(dev['node'] for dev in inventory)),
+        sum(sizes) / 1024.0 ** 4, max_devices)
+    print "{0:>6} {1:>5} {2:>8} {3:>10} {4:>8} {5:>9} {6:>8} {7:>10} " \
+          "{8:>10} {9:>9} {10:>12}".format(
+              "layout", "zones", "replicas", "part_power", "over,%",
+              "under,%", "hot_skew", "zone_sh,%", "node_sh,%", "min_parts",
+              "parts@max")
+    for res in results:
+        print report_templ.format(**res)
+    print
+    print "Recommended: layout={layout} replicas={replicas} " \
+          "part_power={part_power}".format(**best)
+    print "Part power for {0} devices: {1}".format(
+        max_devices, growth_part_power(max_devices, best['replicas']))
+
+
+def analyze_inventory(inventory, max_devices=None, preferred_replicas=3,
+                      objects=None):
+    """run analysis and print report, returns recommended result"""
+    if max_devices is None:
+        max_devices = len(inventory) * growth
+    results = analyze(inventory, max_devices=max_devices, objects=objects)
+    best = recommend(results, preferred_replicas)
+    print_report(inventory, results, best, max_devices)
+    return best
+
+
+def device_key(dev):
+    return "{0}/{1}".format(dev['ip'], dev['device'])
+
+
+def ring_inventory(inventory, classes):
+    """devices of ring with device classes, all if classes is None"""
+    if classes is None:
+        return inventory
+    return [dev for dev in inventory if dev.get('class') in classes]
+
+
+def inventory_weights(inventory):
+    return dict((device_key(dev), device_weight(dev)) for dev in inventory)
+
+
+def parts_by_weight(weights, total_parts):
+    """{dev_key: partition replicas}, expected for weights"""
+    total = sum(weights.values())
+    return dict((key, weight / total * total_parts)
+                for key, weight in weights.items())
+
+
+def estimate_movement(old_parts, new_parts):
+    """partition replicas, moved in and out of every device and node"""
+    devices = {}
+    for key in set(old_parts) | set(new_parts):
+        delta = new_parts.get(key, 0) - old_parts.get(key, 0)
+        devices[key] = {'in': max(0, delta), 'out': max(0, -delta)}
+
+    nodes = {}
+    for key, moves in devices.items():
+        node = nodes.setdefault(key.split("/")[0], {'in': 0, 'out': 0})
+        node['in'] += moves['in']
+        node['out'] += moves['out']
+
+    return {'moved': sum(moves['in'] for moves in devices.values()),
+            'devices': devices,
+            'nodes': nodes}
+
+
+def replication_hours(movement, part_bytes, node_mbps):
+    """{ip: hours}, node sends and receives at the same time"""
+    hours = {}
+    for ip, moves in movement['nodes'].items():
+        mbps = node_mbps.get(ip, default_replication_mbps)
+        moved = max(moves['in'], moves['out']) * part_bytes
+        hours[ip] = moved / (mbps * 1024.0 ** 2) / 3600
+    return hours
+
+
+def partition_bytes(inventory, part_power, replicas):
+    """average size of partition replica by used space"""
+    used = sum(dev.get('used', 0) for dev in inventory)
+    return used / float(2 ** part_power * replicas)
+
+
+def interpolate(old_weights, new_weights, share):
+    weights = {}
+    for key in set(old_weights) | set(new_weights):
+        old = old_weights.get(key, 0)
+        weights[key] = old + (new_weights.get(key, 0) - old) * share
+    return weights
+
+
+def next_share(old_weights, new_weights, prev, pos, total_parts, max_moved,
+               iterations=30):
+    """largest interpolation share after pos, which moves at most max_moved
+    replicas from prev, found by bisection"""
+    def moved(share):
+        parts = parts_by_weight(interpolate(old_weights, new_weights, share),
+                                total_parts)
+        return estimate_movement(prev, parts)['moved']
+
+    if moved(1.0) <= max_moved:
+        return 1.0
+
+    low, high = pos, 1.0
+    for _ in range(iterations):
+        mid = (low + high) / 2
+        if moved(mid) <= max_moved:
+            low = mid
+        else:
+            high = mid
+
+    # always make progress, even if cap is below one bisection step
+    return low if low > pos else high
+
+
+def ramp_plan(old_inventory, new_inventory, part_power, replicas,
+              node_mbps, min_part_hours=1, step_share=max_step_share):
+    """steps of gradual weight change from old to new inventory, each
+    moving at most step_share of all partition replicas"""
+    total_parts = 2 ** part_power * replicas
+    part_bytes = partition_bytes(old_inventory, part_power, replicas)
+    old_weights = inventory_weights(old_inventory)
+    new_weights = inventory_weights(new_inventory)
+    max_moved = step_share * total_parts
+
+    prev = parts_by_weight(old_weights, total_parts)
+
+    plan = []
+    start = 0.0
+    share = 0.0
+    while share < 1.0:
+        share = next_share(old_weights, new_weights, prev, share,
+                           total_parts, max_moved)
+        weights = interpolate(old_weights, new_weights, share)
+        parts = parts_by_weight(weights, total_parts)
+        movement = estimate_movement(prev, parts)
+        hours = replication_hours(movement, part_bytes, node_mbps)
+        repl_hours = max(hours.values()) if hours else 0
+        plan.append({'step': len(plan) + 1,
+                     'start_hour': start,
+                     'weights': dict((key, weight)
+                                     for key, weight in weights.items()
+                                     if weight != old_weights.get(key)),
+                     'moved': movement['moved'],
+                     'moved_bytes': movement['moved'] * part_bytes,
+                     'hours': repl_hours})
+        # swift moves one replica of partition per min_part_hours
+        start += max(min_part_hours, repl_hours)
+        prev = parts
+
+    return plan
+
+
+def print_movement(old_inventory, new_inventory, part_power, replicas,
+                   node_mbps):
+    total_parts = 2 ** part_power * replicas
+    movement = estimate_movement(
+        parts_by_weight(inventory_weights(old_inventory), total_parts),
+        parts_by_weight(inventory_weights(new_inventory), total_parts))
+    part_bytes = partition_bytes(old_inventory, part_power, replicas)
+    hours = replication_hours(movement, part_bytes, node_mbps)
+
+    print "{0:.0f} of {1} partition replicas ({2:.1f}%), {3:.1f} GiB " \
+          "moved".format(movement['moved'], total_parts,
+                         movement['moved'] * 100.0 / total_parts,
+                         movement['moved'] * part_bytes / 1024.0 ** 3)
+    print "{0:>24} {1:>8} {2:>8} {3:>8}".format("node", "in", "out", "hours")
+    for ip in sorted(movement['nodes']):
+        moves = movement['nodes'][ip]
+        print "{0:>24} {1:>8.0f} {2:>8.0f} {3:>8.2f}".format(
+            ip, moves['in'], moves['out'], hours[ip])
+    print "{0:>24} {1:>8} {2:>8}".format("device", "in", "out")
+    for key in sorted(movement['devices']):
+        moves = movement['devices'][key]
+        if moves['in'] >= 0.5 or moves['out'] >= 0.5:
+            print "{0:>24} {1:>8.0f} {2:>8.0f}".format(key, moves['in'],
+                                                       moves['out'])
+
+
+def print_plan(plan):
+    for step in plan:
+        print ("step {step}: at {start_hour:.1f}h move {moved:.0f} " +
+               "replicas, {0:.1f} GiB, replication {hours:.2f}h").format(
+                   step['moved_bytes'] / 1024.0 ** 3, **step)
+        for key in sorted(step['weights']):
+            print "    {0} weight {1:.2f}".format(key, step['weights'][key])
+
+
+def config_mbps(cfg, nodes, tuning_path):
+    """{ip: replication MB/s} from 'replication_mbps' config key (number or
+    {node name: MB/s}, measured), else from last recorded tuning"""
+    value = cfg.get('replication_mbps')
+    if isinstance(value, dict):
+        return dict((node.ip, value[node.name]) for node in nodes.storage
+                    if node.name in value)
+    if value is not None:
+        return dict((node.ip, value) for node in nodes.storage)
+
+    if not os.path.exists(tuning_path):
+        return {}
+    last = open(tuning_path).read().strip().split("\n")[-1]
+    return dict((ip, tuning['replication_mbps'])
+                for ip, tuning in json.loads(last)['nodes'].items()
+                if 'replication_mbps' in tuning)
+
+
+def plan_change(old_inventory, new_inventory, part_power, replicas,
+                node_mbps, min_part_hours=1, weight=None, specs=all_devices):
+    """print movement estimate and staged weight ramp of every ring in
+    specs, returns {ring name: plan}. weight is used for devices without
+    'weight', instead of capacity. Old devices without 'class' get class
+    of the same new device"""
+    if weight is not None:
+        old_inventory = [dict({'weight': weight}, **dev)
+                         for dev in old_inventory]
+        new_inventory = [dict({'weight': weight}, **dev)
+                         for dev in new_inventory]
+
+    classes = dict((device_key(dev), dev['class'])
+                   for dev in new_inventory if 'class' in dev)
+    old_inventory = [dict({'class': classes.get(device_key(dev))}, **dev)
+                     for dev in old_inventory]
+
+    plans = {}
+    for name, _, ring_classes in specs:
+        old_devs = ring_inventory(old_inventory, ring_classes)
+        new_devs = ring_inventory(new_inventory, ring_classes)
+        if sum(inventory_weights(old_devs).values()) <= 0:
+            abort("No weighted devices of ring {0} in old inventory".format(
+                name))
+        if sum(inventory_weights(new_devs).values()) <= 0:
+            abort("No weighted devices of ring {0} in new inventory".format(
+                name))
+        print "ring {0}: {1} -> {2} devices".format(name, len(old_devs),
+                                                   len(new_devs))
+        print_movement(old_devs, new_devs, part_power, replicas, node_mbps)
+        print
+        plans[name] = ramp_plan(old_devs, new_devs, part_power, replicas,
+                                node_mbps, min_part_hours)
+        print_plan(plans[name])
+        print
+    return plans
+
+
+def load_inventory(path):
+    if not os.path.exists(path):
+        abort("No device inventory {0}, it is stored by deploy and "
+              "analyze_rings".format(path))
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def store_inventory(path, inventory):
+    with open(path, "w") as fd:
+        json.dump(inventory, fd, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == 'plan':
+        new_inventory = load_inventory(sys.argv[3])
+        mbps = float(sys.argv[7]) if len(sys.argv) > 7 else \
+            default_replication_mbps
+        plan_change(load_inventory(sys.argv[2]), new_inventory,
+                    int(sys.argv[4]), int(sys.argv[5]),
+                    dict((dev['ip'], mbps) for dev in new_inventory),
+                    float(sys.argv[6]) if len(sys.argv) > 6 else 1)
+    else:
+        max_devices = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        objects = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        analyze_inventory(load_inventory(sys.argv[1]), max_devices,
+                          objects=objects)
@@ -0,0 +1,214 @@
+"""
+Swift rings, built on admin node
+
+If swift python package is installed, rings are built in-process with
+swift RingBuilder. Otherwise all swift-ring-builder commands are executed
+on one node as single script. In both cases result is {file_name: data}
+of *.builder and *.ring.gz files, ready to be distributed.
+
+Devices can be split between rings by class (ring_classes config key,
+e.g. account and container rings on ssd, object on hdd), and every object
+storage policy (storage_policies key) gets own object ring with devices
+of its classes: object.ring.gz for policy 0, object-N.ring.gz for policy N.
+Object ring classes are set by policies then, so 'object' key of
+ring_classes together with storage_policies is rejected.
+
+Files are distributed by content: only files with other md5 on node
+are uploaded, and after upload all nodes must have the same ring version
+(hash of md5 of all files).
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from fabric.utils import abort, puts
+
+try:
+    from swift.common.ring import RingBuilder
+    no_swift = False
+except ImportError:
+    no_swift = True
+
+
+ring_ports = [('account', 6002),
+              ('container', 6001),
+              ('object', 6003)]
+
+# (ring name, port, device classes or None for all devices)
+default_specs = [(name, port, None) for name, port in ring_ports]
+
+
+def spec_files(specs):
+    return [name + ext for name, _, _ in specs
+            for ext in ('.builder', '.ring.gz')]
+
+
+ring_files = spec_files(default_specs)
+
+
+def policy_ring(idx):
+    return "object" if idx == 0 else "object-{0}".format(idx)
+
+
+def ring_specs(cfg):
+    """specs of all rings from ring_classes and storage_policies"""
+    ring_classes = cfg.get('ring_classes', {})
+    policies = cfg.get('storage_policies')
+    if policies and 'object' in ring_classes:
+        raise ValueError("ring_classes 'object' can't be used with "
+                         "storage_policies, set 'classes' of policies")
+
+    specs = []
+    for name, port in ring_ports:
+        if name != 'object' or not policies:
+            specs.append((name, port, ring_classes.get(name)))
+        else:
+            for idx, policy in enumerate(policies):
+                specs.append((policy_ring(idx), port, policy.get('classes')))
+    return specs
+
+
+def storage_policies_conf(swift_conf, policies):
+    """replace [storage-policy:N] sections of swift.conf text"""
+    lines = []
+    skip = False
+    for line in swift_conf.split("\n"):
+        if line.strip().startswith("["):
+            skip = line.strip().startswith("[storage-policy:")
+        if not skip:
+            lines.append(line)
+
+    default = [policy.get('default', False) for policy in policies]
+    if not any(default):
+        default[0] = True
+
+    for idx, policy in enumerate(policies):
+        lines.append("[storage-policy:{0}]".format(idx))
+        lines.append("name = " + policy['name'])
+        if default[idx]:
+            lines.append("default = yes")
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def ring_devices(nodes, port, weights=None, classes=None, dev_classes=None):
+    """device dicts of all storage nodes, device name is mount dir name.
+    Zone is 'zone' of storage node, weight is from weights
+    ({ip: {dev: weight}}), every device must have it.
+    If classes is given, only devices of these classes are used"""
+    weights = weights or {}
+    devs = []
+    for node in nodes.storage:
+        for dev, mount in sorted(node.dev2dir.items(), key=lambda x: x[1]):
+            if classes is not None and \
+                    dev_classes[node.ip][dev] not in classes:
+                continue
+            if dev not in weights.get(node.ip, {}):
+                raise ValueError("No weight of {0}:{1} in inventory".format(
+                    node.name, dev))
+            devs.append({'region': 1,
+                         'zone': node.zone,
+                         'ip': node.ip,
+                         'port': port,
+                         'replication_ip': node.ip,
+                         'replication_port': port,
+                         'device': os.path.basename(mount.strip()),
+                         'weight': weights[node.ip][dev],
+                         'meta': ''})
+
+    if not devs:
+        if classes is None:
+            raise ValueError("No devices for port {0}".format(port))
+        raise ValueError("No devices of classes {0} for port {1}".format(
+            ", ".join(classes), port))
+    return devs
+
+
+def build_ring(builder_path, ring_path, devs, part_power, replicas,
+               min_part_hours):
+    builder = RingBuilder(part_power, replicas, min_part_hours)
+    for dev in devs:
+        builder.add_dev(dev)
+    builder.rebalance()
+    builder.save(builder_path)
+    builder.get_ring().save(ring_path)
+    return builder
+
+
+def build_rings(nodes, replicas, part_power=10, min_part_hours=1,
+                specs=default_specs, dev_classes=None, weights=None):
+    """build all rings locally, returns {file_name: data}"""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name, port, classes in specs:
+            build_ring(os.path.join(tmp_dir, name + ".builder"),
+                       os.path.join(tmp_dir, name + ".ring.gz"),
+                       ring_devices(nodes, port, weights, classes,
+                                    dev_classes),
+                       part_power, float(replicas), min_part_hours)
+
+        return dict((fname, open(os.path.join(tmp_dir, fname), "rb").read())
+                    for fname in spec_files(specs))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def load_ring_files(ring_dir, fnames=ring_files):
+    """ring files from local directory, e.g. after manual rebalance"""
+    return dict((fname, open(os.path.join(ring_dir, fname), "rb").read())
+                for fname in fnames)
+
+
+def ring_builder_script(nodes, replicas, part_power=10, min_part_hours=1,
+                        specs=default_specs, dev_classes=None, weights=None):
+    """shell script, which builds all rings in current directory"""
+    cmds = ["rm -f " + " ".join(spec_files(specs))]
+    for name, port, classes in specs:
+        builder = name + ".builder"
+        cmds.append("swift-ring-builder {0} create {1} {2} {3}".format(
+            builder, part_power, replicas, min_part_hours))
+        for dev in ring_devices(nodes, port, weights, classes, dev_classes):
+            cmds.append("swift-ring-builder {0} add r{1}z{2}-{3}:{4}/{5} {6}"
+                        .format(builder, dev['region'], dev['zone'],
+                                dev['ip'], dev['port'], dev['device'],
+                                dev['weight']))
+        # rebalance returns 1, if nothing was moved, e.g. with one replica
+        cmds.append("( swift-ring-builder {0} rebalance || [ $? -eq 1 ] )"
+                    .format(builder))
+    return " && ".join(cmds)
+
+
+def ring_digests(files):
+    return dict((fname, hashlib.md5(data).hexdigest())
+                for fname, data in files.items())
+
+
+def ring_version(digests):
+    return hashlib.md5(" ".join(digests[fname]
+                                for fname in sorted(digests))).hexdigest()
+
+
+def parse_md5sum(out):
+    """{file_name: md5} from md5sum output"""
+    res = {}
+    for line in out.split("\n"):
+        if len(line.split()) == 2:
+            md5, path = line.split()
+            res[os.path.basename(path)] = md5
+    return res
+
+
+def check_ring_versions(files, host_digests):
+    """abort, if any host has other ring version, than files"""
+    version = ring_version(ring_digests(files))
+    bad_hosts = sorted(host for host, digests in host_digests.items()
+                       if ring_version(digests) != version)
+    if bad_hosts:
+        abort("Ring version {0} not found on {1}".format(
+            version, ", ".join(bad_hosts)))
+    puts("Ring version {0} is on all {1} nodes".format(version,
+                                                       len(host_digests)))
+    return version
@@ -0,0 +1,455 @@
+"""code shared by deploy_swift.py and ds_new.py: nodes, prepare,
+memcache, proxy, rings and storage configs and services"""
+
+import json
+import uuid
+import hashlib
+import os.path
+from StringIO import StringIO
+
+import yaml
+
+from facts import get_facts, gather_facts
+from tracing import run, sudo, put, get, execute
+from pkg_cache import mirror_url, rewrite_repos_cmd
+from swift_templates import get_template, default_release
+from rings import no_swift, build_rings, ring_builder_script, spec_files
+from rings import ring_digests, parse_md5sum, check_ring_versions
+from rings import load_ring_files, ring_specs, storage_policies_conf
+from devices import get_dev_classes
+import ring_analyzer
+from swift_tuning import node_tuning, server_options, apply_options
+
+from fabric.api import task
+from fabric.context_managers import cd, hide
+from fabric.api import parallel
+
+
+def get_distro():
+    return get_facts()['distro']
+
+
+class Node(object):
+    def __init__(self, name, ip):
+        self.name = name
+        self.ip = ip
+
+
+
+class Nodes(object):
+    def __init__(self):
+        self.storage = []
+        self.proxy = []
+        self.controler = None
+        self.all_ip = set()
+
+
+def cfg_hosts(path):
+    """all hosts from config, to connect to them in advance"""
+    cfg = yaml.load(open(path).read())
+    hosts = set(node['ip'].strip() for node in cfg['storage_nodes'].values())
+    hosts.update(ip.strip() for ip in cfg['proxy_nodes'].values())
+    hosts.add(cfg['memcache_node'].strip())
+    hosts.update(ip.strip() for ip in cfg.get('testnodes', []))
+    return sorted(hosts)
+
+
+
+#  --------------------------------------- BASIC PREPARE ----------------------------------------------
+
+rdo_release_url = "http://rdo.fedorapeople.org/openstack-kilo/rdo-release-kilo.rpm"
+
+
+@task
+@parallel
+def prepare(cache_url=None):
+    if 'rh' == get_distro():
+        sudo("systemctl stop firewalld.service", warn_only=True)
+        sudo("systemctl disable firewalld.service", warn_only=True)
+        with hide('stdout', 'stderr'):
+            sudo("yum -y install epel-release")
+            sudo("yum -y install " + mirror_url(cache_url, rdo_release_url))
+            if cache_url:
+                sudo(rewrite_repos_cmd(cache_url, "/etc/yum.repos.d/rdo-*.repo"))
+            sudo("yum -y upgrade")
+            sudo("yum -y install ntp")
+
+    sudo("groupadd swift")
+    sudo("useradd swift -g swift -M -n")
+
+    sudo("rm /etc/localtime")
+    sudo("cp /usr/share/zoneinfo/Europe/Kiev /etc/localtime")
+    sudo("service ntpd stop", warn_only=True)
+    sudo("ntpdate pool.ntp.org", warn_only=True)
+    sudo("service ntpd start", warn_only=True)
+
+
+prox_cfg = """bind_ip = 0.0.0.0
+user = swift
+swift_dir = /etc/swift"""
+
+
+
+def get_ips():
+    return get_facts()['ips']
+
+
+# ------------------------- MEMCACHE --------------------------------------------------
+
+@task
+@parallel
+def deploy_memcache():
+    sudo("yum -y install memcached")
+
+
+@task
+@parallel
+def start_memcache():
+    sudo("systemctl enable memcached.service")
+    sudo("systemctl start memcached.service")
+
+
+@task
+@parallel
+def stop_memcache():
+    sudo("systemctl stop memcached.service")
+    sudo("systemctl disable memcached.service")
+
+
+# ------------------------- PROXY --------------------------------------------------
+
+@task
+@parallel
+def deploy_proxy():
+    sudo("yum -y install openstack-swift-proxy python-swiftclient")
+
+
+def proxy_configs(memcache_ip, release=default_release):
+    prox = get_template('proxy-server.conf', release)
+    prox = prox.replace("# bind_ip = 0.0.0.0", prox_cfg)
+    prox = prox.replace("# account_autocreate = false",
+                        "account_autocreate = true")
+
+    prox = prox.replace("# operator_roles = admin, swiftoperator",
+                        "operator_roles = admin, swiftoperator")
+
+    prox = prox.replace("# memcache_servers = 127.0.0.1:11211",
+                        "memcache_servers = {0}:11211".format(memcache_ip))
+
+    prox = prox.replace("# log_level = INFO", "log_level = ERROR")
+
+    return {'/etc/swift/proxy-server.conf': prox}
+
+
+@task
+@parallel
+def start_proxy():
+    sudo("systemctl enable openstack-swift-proxy.service")
+    sudo("systemctl start openstack-swift-proxy.service")
+
+
+@task
+@parallel
+def stop_proxy():
+    sudo("systemctl stop openstack-swift-proxy.service", warn_only=True)
+    sudo("systemctl disable openstack-swift-proxy.service", warn_only=True)
+
+
+# ------------------------- RINGS --------------------------------------------------
+
+
+@task
+@parallel
+def store_rings(files, swift_dir="/etc/swift"):
+    """upload ring files, which differ from remote ones, into temporary
+    files and rename them into place. Returns {file_name: md5} of
+    files on host after upload"""
+    digests = ring_digests(files)
+    paths = " ".join(os.path.join(swift_dir, fname) for fname in sorted(files))
+    md5_cmd = "md5sum " + paths
+
+    with hide('running', 'stdout', 'warnings'):
+        remote = parse_md5sum(sudo(md5_cmd, warn_only=True))
+
+    renames = []
+    for fname in sorted(files):
+        if remote.get(fname) != digests[fname]:
+            tmp_path = os.path.join(swift_dir,
+                                    ".{0}.{1}".format(fname, digests[fname]))
+            put(remote_path=tmp_path, local_path=StringIO(files[fname]),
+                use_sudo=True)
+            renames.append((tmp_path, os.path.join(swift_dir, fname)))
+
+    if renames:
+        tmp_paths = " ".join(tmp_path for tmp_path, _ in renames)
+        cmds = ["chown swift:swift " + tmp_paths]
+        cmds.extend("mv -f {0} {1}".format(*names) for names in renames)
+        sudo(" && ".join(cmds))
+
+    with hide('running', 'stdout', 'warnings'):
+        return parse_md5sum(sudo(md5_cmd, warn_only=True))
+
+
+@task
+def build_rings_remote(nodes, replicas, part_power, min_part_hours, specs,
+                       dev_classes, weights):
+    """build rings with swift-ring-builder in one call, returns files"""
+    sudo("chown -R swift:swift /etc/swift")
+
+    with cd("/etc/swift"):
+        sudo(ring_builder_script(nodes, replicas, part_power, min_part_hours,
+                                 specs, dev_classes, weights),
+             user='swift')
+
+        files = {}
+        for fname in spec_files(specs):
+            data = StringIO()
+            get(remote_path=fname, local_path=data)
+            files[fname] = data.getvalue()
+
+    return files
+
+
+def setup_rings(nodes, cfg, inventory):
+    """returns {file_name: data} of rings, built on admin node, if swift
+    package is installed here, else on controller. Device weights are
+    from inventory, see ring_analyzer.collect_inventory"""
+    replicas = cfg.get('replication', 3)
+    part_power = cfg.get('part_power', 10)
+    min_part_hours = cfg.get('min_part_hours', 1)
+
+    specs = ring_specs(cfg)
+    weights = ring_analyzer.ring_weights(inventory)
+    dev_classes = None
+    if any(classes is not None for _, _, classes in specs):
+        dev_classes = get_dev_classes(nodes, cfg)
+
+    if no_swift:
+        ip = nodes.controler.ip
+        return execute(build_rings_remote, nodes, replicas, part_power,
+                       min_part_hours, specs, dev_classes, weights,
+                       hosts=[ip])[ip]
+
+    return build_rings(nodes, replicas, part_power, min_part_hours,
+                       specs, dev_classes, weights)
+
+
+acc_cfg = """bind_ip = 0.0.0.0
+user = swift
+swift_dir = /etc/swift
+devices = /srv/node"""
+
+
+cont_cfg = """bind_ip = 0.0.0.0
+user = swift
+swift_dir = /etc/swift
+devices = /srv/node"""
+
+
+obj_cfg = """bind_ip = 0.0.0.0
+user = swift
+swift_dir = /etc/swift
+devices = /srv/node"""
+
+
+def storage_tuning(nodes, cfg):
+    """{ip: tuning} of all storage nodes, see swift_tuning"""
+    facts = gather_facts([node.ip for node in nodes.storage])
+    return dict((node.ip, node_tuning(cfg, cfg['storage_nodes'][node.name],
+                                      len(node.dev2dir), facts[node.ip]))
+                for node in nodes.storage)
+
+
+def storage_configs(release=default_release, tuning=None):
+    """{remote_path: content} of storage node configs"""
+    acc = get_template('account-server.conf', release)
+    acc = acc.replace("# bind_ip = 0.0.0.0", acc_cfg)
+    acc = acc.replace("# recon_cache_path = /var/cache/swift", "recon_cache_path = /var/cache/swift")
+    acc = acc.replace("# log_level = INFO", "log_level = ERROR")
+
+    cont = get_template('container-server.conf', release)
+    cont = cont.replace("# bind_ip = 0.0.0.0", cont_cfg)
+    cont = cont.replace("# recon_cache_path = /var/cache/swift", "recon_cache_path = /var/cache/swift")
+    cont = cont.replace("# log_level = INFO", "log_level = ERROR")
+
+    obj_c = get_template('object-server.conf', release)
+    obj_c = obj_c.replace("# bind_ip = 0.0.0.0", obj_cfg)
+    obj_c = obj_c.replace("# log_level = INFO", "log_level = ERROR")
+    obj_c = obj_c.replace("bind_port = 6000", "bind_port = 6003")
+
+    tuning_files = {}
+    if tuning is not None:
+        acc = apply_options(acc, server_options('account', tuning))
+        cont = apply_options(cont, server_options('container', tuning))
+        obj_c = apply_options(obj_c, server_options('object', tuning))
+        tuning_files['/etc/swift/tuning.json'] = json.dumps(tuning, indent=4,
+                                                            sort_keys=True)
+
+    tuning_files.update({
+        '/etc/swift/account-server.conf': acc,
+        '/etc/swift/container-server.conf': cont,
+        '/etc/swift/object-server.conf': obj_c,
+        '/etc/swift/container-reconciler.conf':
+            get_template('container-reconciler.conf', release),
+        '/etc/swift/object-expirer.conf':
+            get_template('object-expirer.conf', release),
+    })
+    return tuning_files
+
+
+# ---------------------------------  STORAGE --------------------------------------------------------------
+
+@task
+@parallel
+def get_scsi_dev_mapping():
+    id2dev = {}
+    with hide('stdout', 'stderr'):
+        for line in run("lsscsi").split("\n"):
+            vals = line.split()
+            if len(vals) == 6:
+                id2dev[vals[0]] = vals[5]
+    return id2dev
+
+
+def update_fstab(mount_root, mpoints):
+    fstab_sio = StringIO()
+    get(remote_path='/etc/fstab', local_path=fstab_sio)
+    fstab = fstab_sio.getvalue()
+
+    new_fstab = []
+    for line in fstab.split("\n"):
+        pline = line.strip()
+        if pline != "" and not pline.startswith("#"):
+            mpoint = pline.split()[1]
+            if not mpoint.startswith(mount_root):
+                new_fstab.append(line)
+        else:
+            new_fstab.append(line)
+
+    lt = "{0} {1} xfs noatime,nodiratime,nobarrier,logbufs=8 0 0"
+    for dev, mpoint in mpoints:
+        new_fstab.append(lt.format(dev, mpoint))
+
+    put(remote_path='/etc/fstab',
+        local_path=StringIO("\n".join(new_fstab) + "\n"),
+        use_sudo=True)
+
+
+storage_services = """
+    openstack-swift-account.service
+    openstack-swift-account-auditor.service
+    openstack-swift-account-reaper.service
+    openstack-swift-account-replicator.service
+    openstack-swift-container.service
+    openstack-swift-container-auditor.service
+    openstack-swift-container-replicator.service
+    openstack-swift-container-updater.service
+    openstack-swift-object.service
+    openstack-swift-object-auditor.service
+    openstack-swift-object-replicator.service
+    openstack-swift-object-updater.service"""
+
+storage_services = " ".join(storage_services.split())
+
+
+@task
+@parallel
+def start_storage():
+    sudo("chown -R swift:swift /etc/swift /var/cache/swift")
+
+    sudo("systemctl enable " + storage_services)
+    sudo("systemctl start " + storage_services)
+
+
+@task
+@parallel
+def stop_storage():
+    sudo("systemctl stop " + storage_services, warn_only=True)
+    sudo("systemctl disable " + storage_services, warn_only=True)
+
+
+def get_swift_cfg(all_stors, all_proxy, all_mcache, release=default_release,
+                  policies=None):
+    swift_cfg = get_template('swift.conf', release)
+    if policies:
+        swift_cfg = storage_policies_conf(swift_cfg, policies)
+
+    suff = hashlib.md5(str(uuid.uuid1())).hexdigest()
+    swift_cfg = swift_cfg.replace("swift_hash_path_suffix = changeme",
+                                  "swift_hash_path_suffix = " + suff)
+
+    suff = hashlib.md5(str(uuid.uuid1())).hexdigest()
+    return swift_cfg.replace("swift_hash_path_prefix = changeme",
+                             "swift_hash_path_prefix = " + suff)
+
+
+def save_swift_cfg(cfg):
+    put(remote_path='/etc/swift/swift.conf',
+        local_path=StringIO(cfg),
+        use_sudo=True)
+
+
+swift_rc_templ = """
+export ST_AUTH="http://{0}:8080/auth/v1.0/"
+export ST_USER="admin:admin"
+export ST_KEY="admin"
+export SW_NODES="{1}"
+export SW_TOKEN=`curl -v -H  "X-Auth-User:$ST_USER" -H  "X-Auth-Key:$ST_KEY" "$ST_AUTH" 2>&1 | grep X-Auth-Token | awk '{{print $3}}'`
+"""
+
+
+@task
+@parallel
+def deploy_testnode(all_proxy):
+    # if 'rh' == get_distro():
+    #     sudo("systemctl stop firewalld.service", warn_only=True)
+    #     sudo("systemctl disable firewalld.service", warn_only=True)
+    #     with hide('stdout', 'stderr'):
+    #         sudo("yum -y install epel-release")
+    #         sudo("yum -y install http://rdo.fedorapeople.org/openstack-kilo/rdo-release-kilo.rpm")
+    #         sudo("yum -y upgrade")
+    #         sudo("yum -y install ntp")
+
+    # sudo("groupadd swift")
+    # sudo("useradd swift -g swift -M -n")
+
+    # sudo("service ntpd stop", warn_only=True)
+    # sudo("ntpdate pool.ntp.org", warn_only=True)
+    # sudo("service ntpd start", warn_only=True)
+
+    # sudo("rm /etc/localtime")
+    # sudo("cp /usr/share/zoneinfo/Europe/Kiev /etc/localtime")
+    # sudo("yum -y install python-swiftclient git ")
+    # run("git clone https://github.com/markseger/getput.git")
+
+    swift_rc = swift_rc_templ.format(all_proxy[0],
+                                     ",".join(ip for ip in all_proxy))
+    put(remote_path='swiftrc',
+        local_path=StringIO(swift_rc))
+
+
+ring_commands = ('analyze_rings', 'plan_rings', 'push_rings')
+
+
+def ring_command(cmd, conf_path, nodes, cfg, all_swift):
+    """run one of ring_commands for config at conf_path"""
+    if cmd == 'analyze_rings':
+        inventory = ring_analyzer.collect_inventory(nodes, cfg)
+        ring_analyzer.store_inventory(conf_path + ".ring_devices", inventory)
+        ring_analyzer.analyze_inventory(inventory,
+                                        cfg.get('max_ring_devices'),
+                                        cfg.get('replication', 3),
+                                        cfg.get('expected_objects'))
+    elif cmd == 'plan_rings':
+        ring_analyzer.plan_change(
+            ring_analyzer.load_inventory(conf_path + ".ring_devices"),
+            ring_analyzer.collect_inventory(nodes, cfg),
+            cfg.get('part_power', 10), cfg.get('replication', 3),
+            ring_analyzer.config_mbps(cfg, nodes, conf_path + ".tuning"),
+            cfg.get('min_part_hours', 1), specs=ring_specs(cfg))
+    else:
+        assert cmd == 'push_rings'
+        files = load_ring_files(cfg.get('ring_dir', '.'),
+                                spec_files(ring_specs(cfg)))
+        check_ring_versions(files, execute(store_rings, files,
+                                           hosts=all_swift))
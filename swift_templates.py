@@ -0,0 +1,82 @@
+"""
+Local store of swift sample configs, keyed by swift release
+
+Templates are looked up in swift_templates/RELEASE/ near this file (to ship
+them with the tool) and in ~/.deploy_swift_templates/RELEASE/. Missing
+ones are downloaded from git.openstack.org once and stored there. To
+prefetch all templates of release for offline deployment
+
+    $ python swift_templates.py fetch kilo
+"""
+
+import os
+import sys
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+
+templ_url = "https://git.openstack.org/cgit/openstack/swift/plain/etc/" + \
+            "{0}-sample?h=stable/{1}"
+shipped_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "swift_templates")
+store_dir = os.path.expanduser("~/.deploy_swift_templates")
+default_release = "kilo"
+
+template_names = ['swift.conf',
+                  'proxy-server.conf',
+                  'account-server.conf',
+                  'container-server.conf',
+                  'object-server.conf',
+                  'container-reconciler.conf',
+                  'object-expirer.conf']
+
+_templates = {}
+
+
+def fetch_template(name, release):
+    data = urllib2.urlopen(templ_url.format(name, release),
+                           timeout=60).read()
+
+    dname = os.path.join(store_dir, release)
+    if not os.path.isdir(dname):
+        try:
+            os.makedirs(dname)
+        except OSError:
+            # created by other fetch thread
+            if not os.path.isdir(dname):
+                raise
+
+    fname = os.path.join(dname, name)
+    with open(fname + ".tmp", "w") as fd:
+        fd.write(data)
+    os.rename(fname + ".tmp", fname)
+
+    return data
+
+
+def get_template(name, release=default_release):
+    key = (name, release)
+    if key not in _templates:
+        for root in (shipped_dir, store_dir):
+            fname = os.path.join(root, release, name)
+            if os.path.isfile(fname):
+                _templates[key] = open(fname).read()
+                break
+        else:
+            _templates[key] = fetch_template(name, release)
+    return _templates[key]
+
+
+def fetch_all(release=default_release):
+    pool = ThreadPool(len(template_names))
+    try:
+        pool.map(lambda name: fetch_template(name, release), template_names)
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    assert sys.argv[1] == 'fetch'
+    release = sys.argv[2] if len(sys.argv) > 2 else default_release
+    fetch_all(release)
+    print "Templates stored in", os.path.join(store_dir, release)
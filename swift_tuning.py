@@ -0,0 +1,213 @@
+"""
+Per-node swift storage servers tuning
+
+Replication throughput of storage node is limited by its disks and nic.
+Tuning profile (storage node 'tuning' key in config, or global 'tuning',
+'default' if none) gives expected streaming rate of one disk and of one
+rsync stream, and share of nic bandwidth, which replication may use.
+From them and node facts (device count, nic speed) are derived:
+
+    * rsync 'max connections' of every per-device rsync module
+    * object replicator concurrency
+    * account/container replicator concurrency
+
+From cores, memory and device count are derived servers workers,
+max_clients, object server threads_per_disk and object auditor
+concurrency and rate limits. servers_per_port needs ring with port per
+device, so it's used only if set for storage node in config.
+
+Nic speed can be set by 'nic_speed' (Mb/s) key of storage node, if facts
+can't tell it (virtual nics).
+"""
+
+import re
+import math
+import json
+import time
+import os.path
+
+
+# disk_mbps, stream_mbps, audit_mbps and nic speeds are in MB/s
+profiles = {
+    'conservative': {'disk_mbps': 80, 'stream_mbps': 40,
+                     'nic_share': 0.3, 'max_conn_per_dev': 2,
+                     'threads_per_disk': 2, 'clients_per_gb': 32,
+                     'audit_files_per_sec': 10, 'audit_mbps': 5},
+    'default': {'disk_mbps': 100, 'stream_mbps': 25,
+                'nic_share': 0.5, 'max_conn_per_dev': 4,
+                'threads_per_disk': 4, 'clients_per_gb': 64,
+                'audit_files_per_sec': 20, 'audit_mbps': 10},
+    'throughput': {'disk_mbps': 150, 'stream_mbps': 20,
+                   'nic_share': 0.8, 'max_conn_per_dev': 8,
+                   'threads_per_disk': 8, 'clients_per_gb': 128,
+                   'audit_files_per_sec': 40, 'audit_mbps': 20},
+}
+
+# used if nic speed is unknown, 1Gb/s
+default_nic_mbps = 1000 / 8.0
+min_conn_per_dev = 2
+min_clients = 256
+max_clients = 4096
+devs_per_auditor = 8
+
+rsync_head_templ = """
+uid = swift
+gid = swift
+log file = /var/log/rsyncd.log
+pid file = /var/run/rsyncd.pid
+address = {rsync_ip}
+"""
+
+rsync_module_templ = """
+[{server}_{device}]
+max connections = {max_connections}
+path = {mount_root}/
+read only = false
+lock file = /var/lock/{server}_{device}.lock
+"""
+
+servers = ['account', 'container', 'object']
+
+
+def nic_mbps(node_config, facts):
+    """fastest known nic of node in MB/s"""
+    if 'nic_speed' in node_config:
+        return int(node_config['nic_speed']) / 8.0
+
+    speeds = [speed for speed in facts.get('nics', {}).values() if speed]
+    if not speeds:
+        return default_nic_mbps
+    return max(speeds) / 8.0
+
+
+def node_tuning(cfg, node_config, dev_count, facts):
+    """replication settings for storage node with dev_count devices"""
+    name = node_config.get('tuning', cfg.get('tuning', 'default'))
+    if name not in profiles:
+        raise ValueError("Unknown tuning profile {0!r}, use one of {1}".format(
+            name, ", ".join(sorted(profiles))))
+    profile = profiles[name]
+
+    dev_count = max(dev_count, 1)
+    net = nic_mbps(node_config, facts)
+    budget = min(net * profile['nic_share'], dev_count * profile['disk_mbps'])
+
+    # parallel rsync streams, which node can sustain
+    streams = max(1, int(budget / profile['stream_mbps']))
+
+    # devices also receive data from replicators of other nodes
+    per_dev = int(math.ceil(float(streams) / dev_count))
+    per_dev = max(min_conn_per_dev, min(per_dev, profile['max_conn_per_dev']))
+
+    cores = facts.get('cores', 1)
+    mem_gb = facts.get('mem', 0) / 1024.0 ** 3
+    obj_workers = max(2, min(cores, dev_count))
+    db_workers = max(2, cores // 4)
+    clients = int(mem_gb * profile['clients_per_gb'] / obj_workers)
+    clients = max(min_clients, min(clients, max_clients))
+
+    return {'profile': name,
+            'devices': dev_count,
+            'nic_mbps': net,
+            'cores': cores,
+            'mem_gb': round(mem_gb, 1),
+            'replication_mbps': budget,
+            'max_connections': per_dev,
+            'replicator_concurrency': streams,
+            'db_replicator_concurrency': max(1, streams // 4),
+            'object_workers': obj_workers,
+            'db_workers': db_workers,
+            'max_clients': clients,
+            'threads_per_disk': profile['threads_per_disk'],
+            'servers_per_port': int(node_config.get('servers_per_port', 0)),
+            'auditor_concurrency': max(1, dev_count // devs_per_auditor),
+            'audit_files_per_second': profile['audit_files_per_sec'],
+            'audit_bytes_per_second': profile['audit_mbps'] * 1024 ** 2}
+
+
+def rsync_conf(rsync_ip, mount_root, devices, tuning):
+    """rsyncd.conf with module for every server and device"""
+    parts = [rsync_head_templ.format(rsync_ip=rsync_ip)]
+    for server in servers:
+        for device in sorted(devices):
+            parts.append(rsync_module_templ.format(
+                server=server, device=device, mount_root=mount_root,
+                max_connections=tuning['max_connections']))
+    return "".join(parts)
+
+
+def set_option(conf, section, key, value):
+    """set key in [section] of ini file text, replacing 'key = ...' or
+    '# key = ...' line, or adding it right after section header"""
+    lines = conf.split("\n")
+    header = "[{0}]".format(section)
+    if header not in [line.strip() for line in lines]:
+        return conf.rstrip("\n") + "\n\n{0}\n{1} = {2}\n".format(header,
+                                                                 key, value)
+
+    start = [line.strip() for line in lines].index(header) + 1
+    end = start
+    while end < len(lines) and not lines[end].strip().startswith("["):
+        end += 1
+
+    key_rr = re.compile(r"^#?\s*{0}\s*=".format(re.escape(key)))
+    new_line = "{0} = {1}".format(key, value)
+    for pos in range(start, end):
+        if key_rr.match(lines[pos].strip()):
+            lines[pos] = new_line
+            break
+    else:
+        lines.insert(start, new_line)
+
+    return "\n".join(lines)
+
+
+def replicator_options(server, tuning):
+    """{(section, key): value} of replicator settings of server config"""
+    section = server + "-replicator"
+    module = "{replication_ip}::" + server + "_{device}"
+    if server == 'object':
+        concurrency = tuning['replicator_concurrency']
+    else:
+        concurrency = tuning['db_replicator_concurrency']
+
+    return {(section, 'concurrency'): concurrency,
+            (section, 'rsync_module'): module}
+
+
+def server_options(server, tuning):
+    """{(section, key): value} of all tuned settings of server config"""
+    options = replicator_options(server, tuning)
+    options[('DEFAULT', 'max_clients')] = tuning['max_clients']
+
+    if server != 'object':
+        options[('DEFAULT', 'workers')] = tuning['db_workers']
+        return options
+
+    options[('DEFAULT', 'workers')] = tuning['object_workers']
+    if tuning['servers_per_port'] > 0:
+        options[('DEFAULT', 'servers_per_port')] = tuning['servers_per_port']
+    options[('app:object-server', 'threads_per_disk')] = \
+        tuning['threads_per_disk']
+    options[('object-auditor', 'concurrency')] = \
+        tuning['auditor_concurrency']
+    options[('object-auditor', 'files_per_second')] = \
+        tuning['audit_files_per_second']
+    options[('object-auditor', 'bytes_per_second')] = \
+        tuning['audit_bytes_per_second']
+    return options
+
+
+def record_tuning(conf_path, tunings):
+    """append {ip: tuning} of deployment to CONFIG.tuning json lines file,
+    to find settings of cluster, used in benchmark run"""
+    with open(conf_path + ".tuning", "a") as fd:
+        fd.write(json.dumps({'time': time.time(),
+                             'config': os.path.abspath(conf_path),
+                             'nodes': tunings}) + "\n")
+
+
+def apply_options(conf, options):
+    for (section, key), value in sorted(options.items()):
+        conf = set_option(conf, section, key, value)
+    return conf
@@ -0,0 +1,47 @@
+import unittest
+
+from fabric.context_managers import hide
+
+from osd_ramp import SimulatedCluster, default_ramp, ramp_osds
+
+
+class RampOsdsTest(unittest.TestCase):
+    def ramp(self, osd_count, weight, start=0.0, **ramp):
+        cluster = SimulatedCluster(osd_count)
+        cluster.weights.update((osd_num, start)
+                               for osd_num in range(osd_count))
+        ramp = dict(default_ramp, poll_interval=0, **ramp)
+        osd_ids = {'sim': [(None, osd_num, None)
+                           for osd_num in range(osd_count)]}
+        with hide('everything'):
+            ramp_osds(osd_ids, weight, ramp, runner=cluster,
+                      sleep=lambda _: None)
+
+        self.assertLessEqual(cluster.max_moving, ramp['max_backfills'])
+        for osd_num in range(osd_count):
+            self.assertAlmostEqual(cluster.weights[osd_num], weight)
+        return cluster
+
+    def test_budget_holds(self):
+        self.ramp(12, 1.0)
+
+    def test_small_osds_are_batched(self):
+        cluster = self.ramp(12, 0.1)
+        reweights = [cmd for cmd in cluster.log if "crush reweight" in cmd]
+        self.assertEqual(len(reweights), 12)
+
+    def test_large_osds_get_smaller_steps(self):
+        self.ramp(6, 2.0)
+
+    def test_resume_keeps_weights(self):
+        cluster = self.ramp(8, 1.0, start=0.75)
+        reweights = [cmd for cmd in cluster.log if "crush reweight" in cmd]
+        self.assertEqual(len(reweights), 8)
+        self.assertTrue(all(cmd.endswith(" 1.0000") for cmd in reweights))
+
+    def test_small_budget(self):
+        self.ramp(8, 1.0, max_backfills=4, batch=8)
+
+
+if __name__ == "__main__":
+    unittest.main()
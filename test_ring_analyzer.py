@@ -0,0 +1,82 @@
+import sys
+import unittest
+from StringIO import StringIO
+
+from ring_analyzer import ramp_plan, plan_change, max_step_share, hot_skew
+
+
+def make_inventory(nodes, devs_per_node, first_node=0):
+    return [{'ip': "10.0.0.{0}".format(node),
+             'device': "sd{0}".format(chr(ord('b') + dev)),
+             'size': 4 * 1024 ** 4,
+             'used': 1024 ** 4}
+            for node in range(first_node, first_node + nodes)
+            for dev in range(devs_per_node)]
+
+
+class RampPlanTest(unittest.TestCase):
+    part_power = 14
+    replicas = 3
+
+    def check_plan(self, old, new):
+        total_parts = 2 ** self.part_power * self.replicas
+        plan = ramp_plan(old, new, self.part_power, self.replicas, {})
+        for step in plan:
+            self.assertLessEqual(step['moved'],
+                                 max_step_share * total_parts + 1e-6,
+                                 "step {0} moves {1:.2%}".format(
+                                     step['step'],
+                                     step['moved'] / total_parts))
+        return plan
+
+    def test_doubling_keeps_step_cap(self):
+        old = make_inventory(10, 4)
+        new = old + make_inventory(10, 4, first_node=10)
+        plan = self.check_plan(old, new)
+        for key, weight in plan[-1]['weights'].items():
+            self.assertAlmostEqual(weight, 4096.0)
+
+    def test_small_change_is_one_step(self):
+        old = make_inventory(10, 4)
+        new = old + make_inventory(1, 1, first_node=10)
+        self.assertEqual(len(self.check_plan(old, new)), 1)
+
+    def test_no_change(self):
+        old = make_inventory(4, 4)
+        plan = self.check_plan(old, old)
+        self.assertEqual(len(plan), 1)
+        self.assertEqual(plan[0]['moved'], 0)
+
+    def test_rings_are_planned_by_class(self):
+        old = make_inventory(4, 4)
+        for dev in old:
+            dev['class'] = 'ssd' if dev['device'] == 'sdb' else 'hdd'
+        new = old + [dict(dev, **{'class': 'hdd'})
+                     for dev in make_inventory(4, 4, first_node=4)]
+        specs = [('account', 6002, ['ssd']), ('object', 6003, ['hdd'])]
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            plans = plan_change(old, new, self.part_power, self.replicas, {},
+                                specs=specs)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(plans['account'][0]['moved'], 0)
+        self.assertEqual(len(plans['account']), 1)
+        self.assertGreater(len(plans['object']), 1)
+
+
+class HotSkewTest(unittest.TestCase):
+    def test_spread_shrinks_with_objects(self):
+        assigned = [100, 100, 100, 100]
+        few = hot_skew(assigned, assigned, 10 ** 3, 400)
+        many = hot_skew(assigned, assigned, 10 ** 9, 400)
+        self.assertGreater(few, many)
+        self.assertAlmostEqual(many, 1.0, places=3)
+
+    def test_overloaded_device(self):
+        self.assertGreater(hot_skew([120, 80], [100, 100], 10 ** 9, 200),
+                           1.19)
+
+
+if __name__ == "__main__":
+    unittest.main()
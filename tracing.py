@@ -0,0 +1,270 @@
+"""
+Traced versions of fabric remote operations
+
+Every run/sudo/put/get/exists/append/execute call is appended as json
+line to the file from DEPLOY_TRACE environment variable (nothing is
+recorded if it's not set). Current task and phase are per thread, threads
+of threaded executor start with ones of thread, which called execute.
+
+    $ DEPLOY_TRACE=/tmp/trace.jsonl python deploy_ceph.py install conf.yaml
+    $ python tracing.py /tmp/trace.jsonl /tmp/trace.json
+
+Second command prints slowest operations and critical path of every run
+and stores chrome://tracing compatible file.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import bisect
+import functools
+import threading
+import contextlib
+import collections
+
+from fabric import api
+from fabric.api import env
+from fabric.contrib import files
+
+import executor
+
+
+trace_path = os.environ.get("DEPLOY_TRACE")
+run_id = os.environ.setdefault("DEPLOY_TRACE_RUN", str(uuid.uuid4()))
+
+
+class TraceState(threading.local):
+    task = None
+    phase = None
+
+
+curr = TraceState()
+executor.inherit_local(curr)
+
+
+@contextlib.contextmanager
+def phase(name):
+    prev, curr.phase = curr.phase, name
+    try:
+        yield
+    finally:
+        curr.phase = prev
+
+
+def store_event(event):
+    with open(trace_path, "a") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            fd.write(json.dumps(event) + "\n")
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def data_size(path_or_fd):
+    if hasattr(path_or_fd, 'getvalue'):
+        return len(path_or_fd.getvalue())
+    if isinstance(path_or_fd, basestring) and os.path.isfile(path_or_fd):
+        return os.path.getsize(path_or_fd)
+    return None
+
+
+def traced(op, get_cmd, get_size):
+    def closure(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if trace_path is None:
+                return func(*args, **kwargs)
+
+            event = {'run': run_id,
+                     'op': op,
+                     'host': env.host_string,
+                     'task': curr.task,
+                     'phase': curr.phase,
+                     'cmd': str(get_cmd(*args, **kwargs)),
+                     'pid': os.getpid(),
+                     'start': time.time()}
+            ok = False
+            res = None
+            try:
+                res = func(*args, **kwargs)
+                ok = getattr(res, 'succeeded', True)
+                return res
+            finally:
+                event['end'] = time.time()
+                event['ok'] = ok
+                event['bytes'] = get_size(res, *args, **kwargs)
+                store_event(event)
+        return wrapper
+    return closure
+
+
+def cmd_arg(cmd, *args, **kwargs):
+    return cmd
+
+
+def output_size(res, *args, **kwargs):
+    return None if res is None else len(res)
+
+
+def put_target(local_path=None, remote_path=None, *args, **kwargs):
+    return remote_path
+
+
+def put_size(res, local_path=None, *args, **kwargs):
+    return data_size(local_path)
+
+
+def get_source(remote_path, local_path=None, *args, **kwargs):
+    return remote_path
+
+
+def get_size(res, remote_path, local_path=None, *args, **kwargs):
+    return data_size(local_path)
+
+
+def no_size(res, *args, **kwargs):
+    return None
+
+
+def append_size(res, filename, text, *args, **kwargs):
+    if isinstance(text, basestring):
+        return len(text)
+    return sum(len(line) + 1 for line in text)
+
+
+run = traced('run', cmd_arg, output_size)(api.run)
+sudo = traced('sudo', cmd_arg, output_size)(api.sudo)
+put = traced('put', put_target, put_size)(api.put)
+get = traced('get', get_source, get_size)(api.get)
+exists = traced('exists', cmd_arg, no_size)(files.exists)
+append = traced('append', cmd_arg, append_size)(files.append)
+
+
+def execute(task, *args, **kwargs):
+    name = getattr(task, 'name', getattr(task, '__name__', str(task)))
+    prev, curr.task = curr.task, name
+
+    hosts = kwargs.get('hosts')
+    event_host = ",".join(hosts) if hosts else None
+
+    try:
+        if trace_path is None:
+            return executor.execute(task, *args, **kwargs)
+
+        event = {'run': run_id, 'op': 'execute', 'host': event_host,
+                 'task': name, 'phase': curr.phase, 'cmd': name,
+                 'pid': os.getpid(), 'start': time.time(), 'bytes': None}
+        ok = False
+        try:
+            res = executor.execute(task, *args, **kwargs)
+            ok = True
+            return res
+        finally:
+            event['end'] = time.time()
+            event['ok'] = ok
+            store_event(event)
+    finally:
+        curr.task = prev
+
+
+# ---------------------------------- REPORTS ---------------------------------
+
+
+def load_events(path):
+    with open(path) as fd:
+        return [json.loads(line) for line in fd if line.strip() != ""]
+
+
+def chrome_trace(events):
+    """chrome://tracing 'complete' events, one process row per host"""
+    hosts = sorted(set(str(event['host']) for event in events))
+    host_ids = dict((host, pos) for pos, host in enumerate(hosts))
+    t0 = min(event['start'] for event in events)
+
+    trace = []
+    for host, pos in host_ids.items():
+        trace.append({'name': 'process_name', 'ph': 'M', 'pid': pos,
+                      'args': {'name': host}})
+
+    for event in events:
+        trace.append({'name': event['cmd'][:80],
+                      'cat': event['op'],
+                      'ph': 'X',
+                      'pid': host_ids[str(event['host'])],
+                      'tid': event['pid'],
+                      'ts': int((event['start'] - t0) * 1E6),
+                      'dur': int((event['end'] - event['start']) * 1E6),
+                      'args': dict((key, event[key])
+                                   for key in ('task', 'phase', 'bytes',
+                                               'ok', 'run'))})
+    return {'traceEvents': trace}
+
+
+def critical_path(events):
+    """chain of remote operations, ending with the last one, where every
+    operation is the latest one finished before the next one started"""
+    ops = sorted((event for event in events if event['op'] != 'execute'),
+                 key=lambda event: event['end'])
+    if not ops:
+        return []
+
+    ends = [event['end'] for event in ops]
+    path = [ops[-1]]
+    while True:
+        pos = bisect.bisect_right(ends, path[-1]['start'])
+        if pos == 0:
+            break
+        path.append(ops[pos - 1])
+
+    return path[::-1]
+
+
+def format_event(event):
+    return "{0:>8.2f}s  {1:<5} {2:<20} {3:<20} {4}".format(
+        event['end'] - event['start'],
+        event['op'],
+        str(event['host'])[:20],
+        str(event['task'])[:20],
+        event['cmd'][:70])
+
+
+def summary(events, slowest=20):
+    lines = []
+    runs = collections.OrderedDict()
+    for event in sorted(events, key=lambda event: event['start']):
+        runs.setdefault(event['run'], []).append(event)
+
+    for curr_run, run_events in runs.items():
+        ops = [event for event in run_events if event['op'] != 'execute']
+        wall = max(event['end'] for event in run_events) - \
+            min(event['start'] for event in run_events)
+
+        lines.append("Run {0}: {1} operations, {2:.1f}s".format(
+            curr_run, len(ops), wall))
+
+        lines.append("Slowest operations:")
+        for event in sorted(ops, key=lambda event: event['start'] -
+                            event['end'])[:slowest]:
+            lines.append(format_event(event))
+
+        path = critical_path(run_events)
+        busy = sum(event['end'] - event['start'] for event in path)
+        lines.append("Critical path: {0} operations, {1:.1f}s of {2:.1f}s".format(
+            len(path), busy, wall))
+        for event in path:
+            lines.append(format_event(event))
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    events = load_events(sys.argv[1])
+    print summary(events)
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w") as fd:
+            json.dump(chrome_trace(events), fd)